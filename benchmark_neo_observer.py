@@ -0,0 +1,93 @@
+'''
+Benchmarks of neo_observer.
+
+Run with: python benchmark_neo_observer.py
+
+@author: Pierre Thibault
+'''
+import cPickle
+import timeit
+
+from neo_observer import Event, EventCodec, EventType, ObserverRegistry
+
+class Sender(object):
+    pass
+
+def report(title, seconds, count):
+    print "%-45s %10.2f us" % (title, seconds / count * 1e6)
+
+def bench_codec(count=2000):
+    """
+    Compare EventCodec with pickling the whole event.
+    """
+
+    sender = Sender()
+    codec = EventCodec()
+    codec.register_sender(sender, 1)
+    codec.register_name("frame.ready", 1)
+    for size in (64, 64 * 1024, 4 * 1024 * 1024):
+        event = Event(sender, "frame.ready", {"index": 1, \
+                                              "pixels": "x" * size})
+        pickled = cPickle.dumps(event, cPickle.HIGHEST_PROTOCOL)
+        encoded = codec.encode(event)
+        number = max(count * 64 / size, 10) if size > 64 else count
+        report("pickle.dumps, %d bytes" % size, timeit.timeit( \
+          lambda: cPickle.dumps(event, cPickle.HIGHEST_PROTOCOL), \
+          number=number), number)
+        report("EventCodec.encode, %d bytes" % size, timeit.timeit( \
+          lambda: codec.encode(event), number=number), number)
+        report("pickle.loads, %d bytes" % size, timeit.timeit( \
+          lambda: cPickle.loads(pickled), number=number), number)
+        report("EventCodec.decode, %d bytes" % size, timeit.timeit( \
+          lambda: codec.decode(encoded), number=number), number)
+
+class ExpensiveObserver(object):
+    def __call__(self, event):
+        sum(xrange(1000))
+
+def bench_sample(count=20000):
+    """
+    Compare an expensive observer receiving every event with the same
+    observer receiving 1% of them.
+    """
+
+    for sample in (None, 100, 0.01):
+        registry = ObserverRegistry()
+        observer = ExpensiveObserver()
+        registry.add_observer(observer, named="request.finished", \
+                              sample=sample, sample_seed=0)
+        report("send_event, sample=%s" % sample, timeit.timeit( \
+          lambda: registry.send_event("sender", "request.finished"), \
+          number=count), count)
+
+def bench_no_observers(count=100000):
+    """
+    Measure sending events that nobody observes.
+    """
+
+    registry = ObserverRegistry()
+    registry.add_observer(ExpensiveObserver(), named="observed")
+    report("send_event, no observers", timeit.timeit( \
+      lambda: registry.send_event("sender", "not.observed", {"a": 1}), \
+      number=count), count)
+
+class NullObserver(object):
+    def __call__(self, event):
+        pass
+
+def bench_event_type(count=100000):
+    """
+    Compare sending events named by strings and by declared EventType.
+    """
+
+    for name in ("document.saved", EventType("document.saved")):
+        registry = ObserverRegistry()
+        registry.add_observer(NullObserver(), named=name)
+        report("send_event, %r" % name, timeit.timeit( \
+          lambda: registry.send_event("sender", name), number=count), count)
+
+if __name__ == "__main__":
+    bench_codec()
+    bench_sample()
+    bench_no_observers()
+    bench_event_type()
@@ -16,11 +16,57 @@ Created on 2010-08-12
     a type flag for the different types of observers.
 '''
 
+from collections import Counter, OrderedDict, deque
+import Queue
+import cPickle
+import cStringIO
+import gc
+import heapq
 import inspect
+import logging
+import os
+import random
+import select
+import socket
+import struct
+import sys
+import threading
+import time
 import types
+import uuid
 import weakref
 
 
+#==============================================================================
+# EventCascadeError
+#==============================================================================
+
+class EventCascadeError(RuntimeError):
+    """
+    Raised when an event cascade dispatched breadth first is too deep or has
+    a cycle.
+    """
+
+#==============================================================================
+# EventDispatchError
+#==============================================================================
+
+class EventDispatchError(RuntimeError):
+    """
+    Raised with the ERRORS_RAISE_AFTER policy when observers raised
+    exceptions while being notified.
+    """
+    
+    def __init__(self, errors):
+        """
+        @param errors: The list of (observer, event, exception).
+        """
+        
+        super(EventDispatchError, self).__init__(str(len(errors)) + \
+          " observer(s) failed: " + ", ".join(repr(exception) for \
+          observer, event, exception in errors))
+        self.errors = errors
+
 #==============================================================================
 # ObserverRegistry
 #==============================================================================
@@ -35,13 +81,212 @@ class ObserverRegistry(object):
     The default registry. Usually the registry of the application.
     """
     
-    def __init__(self):
+    LOCAL_FIRST = "local first"
+    """
+    Propagation mode: the observers of a registry are notified before the
+    observers of its parent.
+    """
+    
+    PARENT_FIRST = "parent first"
+    """
+    Propagation mode: the observers of the parent are notified before the
+    observers of the registry.
+    """
+    
+    STOP_PROPAGATION = "stop propagation"
+    """
+    Propagation mode: the events having observers in a registry are not
+    propagated to its parent.
+    """
+    
+    RATE_DROP = "drop"
+    """
+    Rate policy: the events exceeding the rate of an observer are dropped.
+    """
+    
+    RATE_KEEP_LATEST = "keep latest"
+    """
+    Rate policy: the latest event exceeding the rate of an observer is kept
+    and delivered by flush_throttled unless a newer event is delivered first.
+    """
+    
+    RATE_QUEUE = "queue"
+    """
+    Rate policy: the events exceeding the rate of an observer are queued and
+    delivered in order, before the newer events, as the rate allows.
+    """
+    
+    rate_queue_capacity = 1024
+    """
+    The maximum number of events queued for an observer with RATE_QUEUE.
+    The oldest events are dropped when the queue is full.
+    """
+    
+    dispatch_cache_size = 4096
+    """
+    The maximum number of names for which the list of observers is cached.
+    The cache is emptied when it is full.
+    """
+    
+    strict_event_types = False
+    """
+    If True, the names given to add_observer must be declared with EventType,
+    so a misspelled name is not silently observed forever.
+    """
+    
+    scheduler_thread = True
+    """
+    If True, the scheduled events are sent by a thread of the registry
+    running while events are scheduled. Otherwise, run_pending must be
+    called to send them.
+    """
+    
+    CYCLE_IGNORE = "ignore"
+    """
+    Cycle policy: an event is dispatched even if it is sent because of an
+    event with the same sender and name.
+    """
+    
+    CYCLE_SKIP = "skip"
+    """
+    Cycle policy: an event sent because of an event with the same sender and
+    name is not dispatched.
+    """
+    
+    CYCLE_RAISE = "raise"
+    """
+    Cycle policy: sending an event because of an event with the same sender
+    and name raises an EventCascadeError.
+    """
+    
+    breadth_first = False
+    """
+    If True, the events sent by the observers are not dispatched
+    recursively: they are queued and dispatched in order once the observers
+    of the current event are notified, by the outermost send_event of the
+    thread. The stack depth stays the same for cascades of any depth.
+    """
+    
+    max_cascade_depth = None
+    """
+    With breadth_first, the maximum number of events causing each other in
+    a cascade before an EventCascadeError is raised. None means no limit.
+    """
+    
+    cascade_cycles = CYCLE_IGNORE
+    """
+    With breadth_first, the cycle policy when an event is sent because of
+    an event with the same sender and name. The events causing an event are
+    only checked with CYCLE_SKIP and CYCLE_RAISE.
+    """
+    
+    cascade_dedup = False
+    """
+    With breadth_first, if True, an event equal to an event waiting to be
+    dispatched in the cascade is dropped. Comparing the events gets the info
+    of the events sent with an info_factory.
+    """
+    
+    ERRORS_RAISE = "raise"
+    """
+    Error policy: an exception raised by an observer is propagated at once
+    and the next observers are not notified.
+    """
+    
+    ERRORS_LOG = "log"
+    """
+    Error policy: an exception raised by an observer is logged and the next
+    observers are notified.
+    """
+    
+    ERRORS_COLLECT = "collect"
+    """
+    Error policy: an exception raised by an observer is kept for take_errors
+    and the next observers are notified.
+    """
+    
+    ERRORS_RAISE_AFTER = "raise after"
+    """
+    Error policy: the exceptions raised by the observers of an event are
+    raised in an EventDispatchError once all the observers are notified.
+    """
+    
+    error_policy = ERRORS_RAISE
+    """
+    The policy for the exceptions raised by the observers.
+    """
+    
+    def __init__(self, sticky_capacity=1024, parent=None, \
+                 propagation=LOCAL_FIRST):
+        """
+        Create a new registry.
+        @param sticky_capacity: The maximum number of sticky events retained.
+        The least recently used events are evicted first. Optional.
+        @param parent: A registry receiving the events sent to this registry.
+        Optional.
+        @param propagation: How the events are propagated to parent. One of
+        LOCAL_FIRST, PARENT_FIRST or STOP_PROPAGATION. Optional.
+        """
+        
+        assert propagation in (ObserverRegistry.LOCAL_FIRST, \
+                               ObserverRegistry.PARENT_FIRST, \
+                               ObserverRegistry.STOP_PROPAGATION), \
+                               "Unknown propagation mode."
+        
         # Create the delegate for each type of observer:
         self.__registries = [i() for i in \
                              _ObserverRegistryDelegate.__subclasses__()]
+        self.__sender_registries = [i for i in self.__registries \
+                                    if i._by_sender]
+        # The observer holders registered with max_calls. A dictionary
+        # mapping each holder to itself so the registered instance can be
+        # found from an equal holder:
+        self.__counted_holders = dict()
+        # The observer holders registered with a rate, mapped to themselves:
+        self.__throttled_holders = dict()
+        # The holders of the observers registered with a breaker:
+        self.__breaker_holders = dict()
+        # The errors kept with ERRORS_COLLECT:
+        self.__errors = deque(maxlen=1024)
+        # The last events sent for sticky names and keys:
+        self.__sticky_events = _StickyEventCache(sticky_capacity)
+        # The chain of registries:
+        self.__parent = parent
+        self.__propagation = propagation
+        self.__children = weakref.WeakSet()
+        if parent:
+            parent.__children.add(self)
+        # The observer holders and sticky caches of the chain for each name,
+        # for the senders without observers or sticky keys of their own. The
+        # senders are not kept alive by the cache:
+        self.__dispatch_cache = dict()
+        # The containers of the senders and of the (sender, name) keys having
+        # observers or sticky keys of their own in the chain, computed when
+        # needed:
+        self.__chain_senders = None
+        # The number of events sent for each (sender, name) when counted:
+        self.__send_counts = None
+        self.__send_counts_capacity = 0
+        # The events sent with send_event_at and send_event_after:
+        self.__scheduler = _Scheduler(self)
+        # The events of the deferred blocks of each thread:
+        self.__deferred = threading.local()
+        # The events to dispatch breadth first of each thread:
+        self.__cascade = threading.local()
+        
+    @property
+    def parent(self):
+        """
+        The registry receiving the events sent to this registry or None.
+        """
+        
+        return self.__parent
     
     def add_observer(self, observer, sent_by=None, named=None, \
-                     method="__call__"):
+                     method="__call__", max_calls=None, replay=False, \
+                     batch=False, rate=None, rate_policy=RATE_DROP, \
+                     sample=None, sample_seed=None, sample_by_sender=False, \
+                     breaker=None):
         """
         Add an observer to the registry. There are four types of registration
         for an observer:
@@ -65,21 +310,98 @@ class ObserverRegistry(object):
         @param method: Method name to call on the observer. If the observer is
         IObserver, receive_event will be used regardless of this value. 
         Optional.
+        @param max_calls: The number of events the observer will receive
+        before being removed automatically. None means no limit. Optional.
+        @param replay: If True, the observer immediately receives the sticky
+        events retained by the registry matching sent_by and named. Optional.
+        @param batch: If True, the observer receives the events sent with
+        send_batch in a single EventBatch instead of one by one. Optional.
+        @param rate: A (count, seconds) tuple limiting the observer to count
+        events by period of seconds. The events exceeding the rate are
+        handled according to rate_policy. Optional.
+        @param rate_policy: RATE_DROP, RATE_KEEP_LATEST or RATE_QUEUE.
+        Optional.
+        @param sample: Deliver only a sample of the events to the observer. An
+        integer N delivers one event in N, a float is the probability to
+        deliver each event. Optional.
+        @param sample_seed: The seed of the random numbers used with a
+        probability. Optional.
+        @param sample_by_sender: If True, the events of a sender are all
+        delivered or all skipped according to sample. Optional.
+        @param breaker: A CircuitBreaker of the observer only, to stop
+        notifying it while it fails or is too slow. Optional.
         """
         
-        _validate_event_name(named)
+        self._validate_registration_name(named)
+        assert max_calls == None or max_calls > 0, "max_calls must be a" + \
+          " positive integer."
         
         self.remove_observer(observer)
         
         # Add in proper registry:
         for i in self.__registries:
             if i._add_observer_cond(sent_by, named):
-                i._add_observer_imp(_ObserverHolder(observer, method), \
-                                    sent_by, named)
+                observer_holder = _ObserverHolder(observer, method)
+                observer_holder.batch = batch
+                if sample != None:
+                    observer_holder.sampler = _Sampler(sample, sample_seed, \
+                                                       sample_by_sender)
+                if rate != None:
+                    observer_holder.throttle = _Throttle(rate[0], rate[1], \
+                      rate_policy, self.rate_queue_capacity)
+                    self.__throttled_holders[observer_holder] = \
+                      observer_holder
+                if breaker != None:
+                    observer_holder.breaker = breaker
+                    self.__breaker_holders[observer_holder] = observer_holder
+                i._add_observer_imp(observer_holder, sent_by, named)
+                if max_calls != None:
+                    observer_holder.remaining_calls = max_calls
+                    observer_holder.registration = (self, i, sent_by, \
+                                                    named)
+                    self.__counted_holders[observer_holder] = \
+                      observer_holder
+                self._invalidate_dispatch_cache()
+                if replay:
+                    self.__replay(observer_holder, sent_by, named)
                 return
         assert False, "Observer registration type unknown."
             
-    def send_event(self, event_or_sender, name=None, info=None):
+    def _validate_registration_name(self, named):
+        """
+        Validate the name given to add_observer.
+        """
+        
+        _validate_event_name(named)
+        assert not self.strict_event_types or named == None or \
+          EventType.get(named) != None, "Event name " + repr(named) + \
+          " is not declared with EventType."
+    
+    def _add_declared_observer(self, observer, table):
+        """
+        Register an instance of an Observing class for all the subscriptions
+        declared by its class in one operation.
+        @param observer: The instance to register. It is weakly referenced.
+        @param table: The _ObserverTable of the class of observer.
+        """
+        
+        self.remove_observer(observer)
+        self._add_declared_holder(_DeclaredObserverHolder(observer, table))
+    
+    def _add_declared_holder(self, observer_holder):
+        """
+        Add a _DeclaredObserverHolder under all the keys of its table.
+        """
+        
+        for sent_by, named in observer_holder.table.keys:
+            for i in self.__registries:
+                if i._add_observer_cond(sent_by, named):
+                    i._add_observer_imp(observer_holder, sent_by, named)
+                    break
+        self._invalidate_dispatch_cache()
+            
+    def send_event(self, event_or_sender, name=None, info=None, \
+                   info_factory=None):
         """
         Send an event to all observers registered for the event.
         @param event_or_sender: The event to send of type Event or the
@@ -88,128 +410,1168 @@ class ObserverRegistry(object):
         Event.
         @param info: Give more information about an event if event_or_sender 
         is not an Event. It is recommended to use a dictionary. Optional. 
+        @param info_factory: A function without argument returning the info,
+        in place of info. It is called at most once, when an observer first
+        accesses the info, and never if no observer does. Optional.
         """
         
-        is_event = isinstance(event_or_sender, Event)
+        # Nothing to do without observers:
+        if not isinstance(event_or_sender, Event) and \
+          not self._must_dispatch(event_or_sender, name):
+            Event._validate_sender_name(event_or_sender, name)
+            self._count_send(event_or_sender, name)
+            return
         
-        # Validation:
-        assert (is_event and name == None) or not is_event, "The name" + \
-          " was supplied two times." 
-        assert (is_event and info == None) or not is_event, "The info" + \
-          " was supplied two times." 
+        event = self._make_event(event_or_sender, name, info, info_factory)
+        if self._defer(event):
+            return
+        if self.breadth_first:
+            self.__send_breadth_first(event)
+        else:
+            self.__dispatch(event)
+            
+    def __dispatch(self, event):
+        """
+        Notify the observers about an event.
+        """
         
-        # Create the event if needed:
-        event = event_or_sender if is_event else \
-          Event(event_or_sender, name, info)  
+        errors = [] if self.error_policy == \
+          ObserverRegistry.ERRORS_RAISE_AFTER else None
+        has_dead_observers = False
+        try:
+            for observer_holder in self._get_observer_holders(event):
+                self._notify(observer_holder, event, errors)
+                # Collect dead weakrefs:
+                has_dead_observers |= observer_holder.is_dead
+        finally:
+            # Remove the dead weakref observers:
+            if has_dead_observers:
+                self.__remove_dead_observers()
+        if errors:
+            raise EventDispatchError(errors)
+    
+    def __send_breadth_first(self, event):
+        """
+        Dispatch an event after the events already sent in the cascade of
+        the current thread. The outermost send dispatches the cascade.
+        """
         
-        # Collect the observer holder:
-        observer_holders = set()
-        for registry in self.__registries:
-            observer_holders |= registry._get_observer_holders(event)
+        cascade = self.__cascade
+        # The node of an event is ((sender, name), depth, node of the event
+        # whose observers sent it):
+        parent = getattr(cascade, "node", None)
+        key = (event.sender, event.name)
+        if parent == None:
+            node = (key, 0, None)
+        else:
+            node = (key, parent[1] + 1, parent)
+            if self.max_cascade_depth != None and \
+              node[1] > self.max_cascade_depth:
+                raise EventCascadeError("Event cascade deeper than " + \
+                  str(self.max_cascade_depth) + " sending " + repr(event) + \
+                  ".")
+            if self.cascade_cycles != ObserverRegistry.CYCLE_IGNORE:
+                ancestor = parent
+                while ancestor != None and ancestor[0] != key:
+                    ancestor = ancestor[2]
+                if ancestor != None:
+                    if self.cascade_cycles == ObserverRegistry.CYCLE_SKIP:
+                        return
+                    raise EventCascadeError("Event cycle sending " + \
+                                            repr(event) + ".")
         
-        # Notify the observers about the event:
+        queue = getattr(cascade, "queue", None)
+        if queue != None:
+            waiting = None
+            if self.cascade_dedup:
+                # The events waiting, with hashable info or else by
+                # (sender, name). An event equal to a waiting one is dropped,
+                # so each is there once:
+                waiting = cascade.waiting
+                try:
+                    if event in waiting:
+                        return
+                    waiting.add(event)
+                except TypeError:
+                    waiting = cascade.unhashed.setdefault(key, [])
+                    if event in waiting:
+                        return
+                    waiting.append(event)
+            queue.append((event, node, waiting))
+            return
+        cascade.queue = queue = deque([(event, node, None)])
+        cascade.waiting = set()
+        cascade.unhashed = dict()
+        try:
+            while queue:
+                event, cascade.node, waiting = queue.popleft()
+                if waiting is cascade.waiting:
+                    waiting.discard(event)
+                elif waiting != None:
+                    waiting.remove(event)
+                self.__dispatch(event)
+        finally:
+            cascade.queue = None
+            cascade.node = None
+            cascade.waiting = None
+            cascade.unhashed = None
+            
+    def send_batch(self, batch):
+        """
+        Send the events of an EventBatch. The observers registered with batch
+        receive in a single call an EventBatch of the events they observe. The
+        other observers receive the events one by one.
+        @param batch: The EventBatch to send.
+        """
+        
+        # Group the events by sender:
+        indices_by_sender = OrderedDict()
+        for index, sender in enumerate(batch.senders):
+            indices = indices_by_sender.get(sender)
+            if indices == None:
+                indices_by_sender[sender] = [index]
+            else:
+                indices.append(index)
+        
+        # Collect the events of each observer holder. The last event of each
+        # sender is the one retained if it is sticky:
+        holders_and_indices = OrderedDict()
+        for indices in indices_by_sender.itervalues():
+            for observer_holder in self._get_batch_holders(batch, \
+                                                           indices[-1]):
+                key = id(observer_holder)
+                if key in holders_and_indices:
+                    holders_and_indices[key][1].extend(indices)
+                else:
+                    holders_and_indices[key] = (observer_holder, \
+                                                list(indices))
+        
+        # Notify the observers about the events:
+        errors = [] if self.error_policy == \
+          ObserverRegistry.ERRORS_RAISE_AFTER else None
         has_dead_observers = False
-        for observer_holder in observer_holders:
-            observer_holder(event)
-            # Collect dead weakrefs:
-            has_dead_observers |= observer_holder.is_dead
-                
-        # Remove the dead weakref observers:
-        if has_dead_observers:
-            self.remove_observer(None)
-                
-    def remove_observer(self, observer):
+        try:
+            for observer_holder, indices in holders_and_indices.itervalues():
+                is_all = len(indices) == len(batch)
+                if observer_holder.batch:
+                    self._notify(observer_holder, batch if is_all \
+                                 else batch.select(sorted(indices)), errors)
+                else:
+                    for index in xrange(len(batch)) if is_all \
+                      else sorted(indices):
+                        self._notify(observer_holder, batch[index], errors)
+                has_dead_observers |= observer_holder.is_dead
+        finally:
+            # Remove the dead weakref observers:
+            if has_dead_observers:
+                self.__remove_dead_observers()
+        if errors:
+            raise EventDispatchError(errors)
+            
+    def deferred(self, key=None):
         """
-        Remove an observer from the registry.
-        @param observer: The observer to remove. The same observer as for 
-        add_observer.
+        Get a context manager deferring the events sent by the current thread
+        until the outermost with block using it exits::
+        
+            with registry.deferred():
+                for item in items:
+                    item.update() # Sends "changed" events
+        
+        An event equal to an event already deferred, or having the same key,
+        is sent once. The events are sent with send_batch, grouped by name in
+        the order they were first sent, so the observers of each
+        (sender, name) are found once. The events are sent even if the block
+        exits with an exception. When an observer raises, the batches of the
+        other names are still sent and the first exception is raised after;
+        with ERRORS_RAISE_AFTER, a single EventDispatchError holds the errors
+        of all the batches.
+        @param key: A function giving the key of an event. The events having
+        the same key are sent once, with the last of these events. None means
+        the events are compared for equality, which gets the info of the
+        events sent with an info_factory. Only the key of the outermost block
+        is used. Optional.
         """
         
-        observer_holder = _NullObserverHolder(observer) if observer else None
-        for registry in self.__registries:
-            registry._remove_observer_imp(observer_holder)
+        return _DeferredDispatch(self, key)
+    
+    def _begin_deferred(self, key):
+        deferred = self.__deferred
+        if not getattr(deferred, "depth", 0):
+            deferred.events = OrderedDict()
+            # The events already deferred, with hashable info or else by
+            # (sender, name):
+            deferred.hashed = set()
+            deferred.unhashed = dict()
+            deferred.key = key
+            deferred.depth = 0
+        deferred.depth += 1
         
-    def clear(self):
+    def _end_deferred(self):
+        deferred = self.__deferred
+        deferred.depth -= 1
+        if deferred.depth:
+            return
+        events_by_key, deferred.events = deferred.events, None
+        deferred.hashed = deferred.unhashed = None
+        if deferred.key == None:
+            events = [event for events in events_by_key.itervalues() \
+                      for event in events]
+        else:
+            events = events_by_key.values()
+        events_by_name = OrderedDict()
+        for event in events:
+            events_by_name.setdefault(event.name, []).append(event)
+        error = None
+        errors = []
+        for name, events in events_by_name.iteritems():
+            try:
+                self.send_batch(EventBatch._from_events(name, events))
+            except EventDispatchError, e:
+                errors.extend(e.errors)
+            except Exception:
+                # Send the other batches before raising:
+                if error == None:
+                    error = sys.exc_info()
+        if error != None:
+            raise error[0], error[1], error[2]
+        if errors:
+            raise EventDispatchError(errors)
+    
+    def _defer(self, event):
         """
-        Remove all the observers.
+        Keep an event sent in a deferred block.
+        @return: True if the event is deferred.
         """
         
-        for registry in self.__registries:
-            registry._clear_imp()
+        events_by_key = getattr(self.__deferred, "events", None)
+        if events_by_key == None:
+            return False
+        deferred = self.__deferred
+        key = deferred.key
+        if key == None:
+            try:
+                if event in deferred.hashed:
+                    return True
+                deferred.hashed.add(event)
+            except TypeError:
+                # The info cannot be hashed, compare with the events having
+                # the same sender and name:
+                events = deferred.unhashed.setdefault( \
+                  (event.sender, event.name), [])
+                if event in events:
+                    return True
+                events.append(event)
+            events_by_key.setdefault((event.sender, event.name), []) \
+              .append(event)
+        else:
+            events_by_key[key(event)] = event
+        return True
+    
+    def send_event_at(self, when, event_or_sender, name=None, info=None, \
+                      info_factory=None):
+        """
+        Send an event at a given time. The events of a registry are sent in
+        order of time by a single scheduler, on its own thread or when
+        run_pending is called if scheduler_thread is False.
+        @param when: The time to send the event, as returned by time.time().
+        @param event_or_sender: The event to send of type Event or the
+        sender of the event.
+        @param name: The name of the event if event_or_sender is not an
+        Event.
+        @param info: Give more information about an event if event_or_sender 
+        is not an Event. Optional. 
+        @param info_factory: A function without argument returning the info,
+        in place of info. Optional.
+        @return: A ScheduledEvent to cancel the event.
+        """
         
-#==============================================================================
-# _ObserverRegistryDelegate
-#==============================================================================
-
-class _ObserverRegistryDelegate(object):
-    """
-    An abstract delegate class for ObserverRegistry representing in a type
-    hierarchy of the different type of observer registration.
-    """
+        event = self._make_event(event_or_sender, name, info, info_factory)
+        return self.__scheduler.schedule(event, \
+          _monotonic() + when - time.time(), when, self.scheduler_thread)
     
-    def __init__(self):
-        if self.__class__ == _ObserverRegistryDelegate:
-            raise TypeError(self.__class__.__name__ + " is an abstract class" \
-              + " that cannot be instantiated.")
+    def send_event_after(self, delay, event_or_sender, name=None, \
+                         info=None, info_factory=None):
+        """
+        Send an event after a delay. See send_event_at.
+        @param delay: The delay in seconds.
+        @param event_or_sender: The event to send of type Event or the
+        sender of the event.
+        @param name: The name of the event if event_or_sender is not an
+        Event.
+        @param info: Give more information about an event if event_or_sender 
+        is not an Event. Optional. 
+        @param info_factory: A function without argument returning the info,
+        in place of info. Optional.
+        @return: A ScheduledEvent to cancel the event.
+        """
+        
+        event = self._make_event(event_or_sender, name, info, info_factory)
+        return self.__scheduler.schedule(event, _monotonic() + delay, \
+          time.time() + delay, self.scheduler_thread)
     
-    def _add_observer_cond(self, sent_by, named):
+    def run_pending(self):
         """
-        Specify if a derived class accept this kind of observer. Must be 
-        overridden.
+        Send the scheduled events that are due. Used to send the scheduled
+        events from an event loop when scheduler_thread is False.
+        @return: The number of events sent.
         """
         
-        raise NotImplementedError()
-
-    def _add_observer_imp(self, observer_holder, sent_by, named):
+        return self.__scheduler.run_pending()
+    
+    def stream(self, sent_by=None, named=None, capacity=1024, \
+               overflow=None):
         """
-        Add an already validated observer holder. Must be overridden.
+        Get an EventStream iterating over the events sent to the registry.
+        The stream is removed from the registry when leaving the with block
+        using it::
+        
+            with registry.stream(named="job.done") as stream:
+                for event in stream:
+                    ...
+        
+        @param sent_by: The sender to observe. Optional.
+        @param named: The name of the events to observe. Optional.
+        @param capacity: The maximum number of events kept until taken.
+        Optional.
+        @param overflow: What happens when an event is sent while capacity
+        events are kept: EventStream.DROP_OLDEST, EventStream.DROP_NEWEST or
+        EventStream.BLOCK. None means EventStream.DROP_OLDEST. Optional.
+        @return: The EventStream.
         """
         
-        raise NotImplementedError()
+        return EventStream(self, sent_by, named, capacity, \
+                           overflow if overflow else EventStream.DROP_OLDEST)
+            
+    __NO_INITIAL = object()
     
-    def _get_observer_holders(self, event):
+    def query_event(self, event_or_sender, name=None, info=None, \
+                    first=False, reducer=None, initial=__NO_INITIAL, \
+                    info_factory=None):
         """
-        Method used to get all the observer holders of an event. Must be 
-        overridden.
+        Send an event to all observers registered for the event and collect
+        the values they return. Without first or reducer, an iterator is
+        returned calling the observers lazily: the observers after the
+        last value taken are never called.
+        @param event_or_sender: The event to send of type Event or the
+        sender of the event.
+        @param name: The name of the event if event_or_sender is not an
+        Event.
+        @param info: Give more information about an event if event_or_sender 
+        is not an Event. Optional. 
+        @param first: If True, return the first value that is not None and
+        stop calling the observers. None is returned if there is no such
+        value. With ERRORS_RAISE_AFTER, the errors of the observers called
+        are raised in place of the value. Optional.
+        @param reducer: A function of two arguments used to combine the values
+        returned like the builtin reduce. Optional.
+        @param initial: The initial value given to reducer. Optional.
+        @param info_factory: A function without argument returning the info,
+        in place of info. Optional.
+        @return: An iterator over the values returned by the observers, the
+        first value if first is True or the reduced value if reducer is given.
         """
-
-        raise NotImplementedError()
+        
+        assert not (first and reducer), "first and reducer are exclusive."
+        errors = [] if self.error_policy == \
+          ObserverRegistry.ERRORS_RAISE_AFTER else None
+        results = self.__iter_results(self._make_event(event_or_sender, name, \
+                                                       info, info_factory), \
+                                      errors)
+        if first:
+            try:
+                for result in results:
+                    if result != None:
+                        break
+                else:
+                    result = None
+            finally:
+                results.close()
+            if errors:
+                raise EventDispatchError(errors)
+            return result
+        if reducer:
+            if initial is ObserverRegistry.__NO_INITIAL:
+                return reduce(reducer, results)
+            return reduce(reducer, results, initial)
+        return results
+        
+    def __iter_results(self, event, errors):
+        """
+        A generator calling the observers of an event one by one and yielding
+        their returned values.
+        @param errors: The list of the errors to raise once all the observers
+        are called with ERRORS_RAISE_AFTER or None.
+        """
+        
+        has_dead_observers = False
+        try:
+            for observer_holder in self._get_observer_holders(event):
+                result = self._notify(observer_holder, event, errors)
+                has_dead_observers |= observer_holder.is_dead
+                if result is not _NOT_CALLED:
+                    yield result
+        finally:
+            if has_dead_observers:
+                self.__remove_dead_observers()
+        if errors:
+            raise EventDispatchError(errors)
+        
+    def _make_event(self, event_or_sender, name, info, info_factory=None):
+        """
+        Validate the arguments of send_event and get the event to send.
+        """
+        
+        is_event = isinstance(event_or_sender, Event)
+        
+        # Validation:
+        assert (is_event and name == None) or not is_event, "The name" + \
+          " was supplied two times." 
+        assert (is_event and info == None and info_factory == None) or \
+          not is_event, "The info was supplied two times." 
+        
+        # Create the event if needed:
+        return event_or_sender if is_event else \
+          Event(event_or_sender, name, info, info_factory)  
     
-    def _remove_observer_imp(self, observer_holder):
+    def _get_observer_holders(self, event):
         """
-        Default implementation of remove an observer_holder.
-        @param observer_holder: An _ObserverHolder or None to delete dead
-        observer holders.
+        Collect the observer holders registered for an event in the chain of
+        registries and retain the event if it is sticky.
+        @return: A tuple of _ObserverHolder in notification order.
         """
         
-        new_dict = dict()
-        for key, set_of_holders in self._registry.iteritems():
-            if observer_holder:
-                set_of_holders.discard(observer_holder)
-            else:
-                holders_to_remove = set()
-                for o in set_of_holders:
-                    if o.is_dead:
-                        holders_to_remove.add(o)
-                set_of_holders -= holders_to_remove
-            if len(set_of_holders) > 0:
-                new_dict[key] = set_of_holders
-        self._registry.clear()
-        self._registry.update(new_dict)
+        self._count_send(event.sender, event.name)
+        observer_holders, sticky_caches = self._get_dispatch_entry(event)
         
-    def _clear_imp(self):
+        # Retain the event for late observers:
+        for sticky_cache in sticky_caches:
+            sticky_cache.put(event)
+        return observer_holders
+    
+    def _get_batch_holders(self, batch, index):
         """
-        Default implementation to remove all observers.
+        Collect the observer holders registered for the events of a batch
+        sent by the sender of the event at index and retain this event if it
+        is sticky. The event is only created to be retained.
+        @return: A tuple of _ObserverHolder in notification order.
         """
         
-        self._registry.clear()
+        sender = batch.senders[index]
+        self._count_send(sender, batch.name)
+        observer_holders, sticky_caches = \
+          self._get_dispatch_entry(_EventKey(sender, batch.name))
+        if sticky_caches:
+            event = batch[index]
+            for sticky_cache in sticky_caches:
+                sticky_cache.put(event)
+        return observer_holders
     
-
+    def _get_dispatch_entry(self, event):
+        """
+        Get the observer holders and the sticky caches of the chain of
+        registries for the sender and the name of an event. The result is
+        cached by name until a registry of the chain is modified, unless the
+        sender has observers or sticky keys of its own.
+        """
+        
+        if self.__has_chain_sender_entries(event.sender, event.name):
+            return self.__compute_dispatch_entry(event, False)
+        return self.__get_name_entry(event)
+    
+    def __get_name_entry(self, event):
+        """
+        Get the dispatch entry of the name of an event, for a sender having
+        no observers or sticky keys of its own in the chain.
+        """
+        
+        entry = self.__dispatch_cache.get(event.name)
+        if entry == None:
+            entry = self.__compute_dispatch_entry(event, True)
+            if len(self.__dispatch_cache) >= self.dispatch_cache_size:
+                self.__dispatch_cache.clear()
+            self.__dispatch_cache[event.name] = entry
+        return entry
+    
+    def __has_chain_sender_entries(self, sender, name):
+        """
+        Tell if a registry of the chain has observers or a sticky key for
+        sender.
+        """
+        
+        chain_senders = self.__chain_senders
+        if chain_senders == None:
+            chain_senders = self.__chain_senders = self.__get_chain_senders()
+        senders, keys = chain_senders
+        if senders == None:
+            # A delegate cannot tell, ask each registry:
+            registry = self
+            while registry != None:
+                if registry.__has_sender_entries(sender, name):
+                    return True
+                registry = registry.__parent
+            return False
+        for container in senders:
+            if sender in container:
+                return True
+        if keys:
+            key = (sender, name)
+            for container in keys:
+                if key in container:
+                    return True
+        return False
+    
+    def __get_chain_senders(self):
+        """
+        Get the containers of the senders and of the (sender, name) keys
+        having observers or sticky keys of their own in the chain. The empty
+        containers are skipped since adding to them invalidates the result.
+        @return: A tuple (senders, keys) of lists of containers or
+        (None, None) if a delegate cannot tell.
+        """
+        
+        senders = []
+        keys = []
+        registry = self
+        while registry != None:
+            for delegate in registry.__sender_registries:
+                containers = delegate._sender_keys()
+                if containers == None:
+                    return None, None
+                if containers[0]:
+                    senders.append(containers[0])
+                if containers[1]:
+                    keys.append(containers[1])
+            sticky_keys = registry.__sticky_events.sender_keys()
+            if sticky_keys:
+                keys.append(sticky_keys)
+            registry = registry.__parent
+        return senders, keys
+    
+    def __has_sender_entries(self, sender, name):
+        """
+        Tell if this registry has observers or a sticky key for sender.
+        """
+        
+        for registry in self.__sender_registries:
+            if registry._has_observers(sender, name):
+                return True
+        return self.__sticky_events.is_sticky_for_sender(sender, name)
+    
+    def __compute_dispatch_entry(self, event, by_name):
+        """
+        @param by_name: True to ignore the registrations by sender.
+        """
+        
+        observer_holders = set()
+        for registry in self.__registries:
+            if not (by_name and registry._by_sender):
+                observer_holders |= registry._get_observer_holders(event)
+        observer_holders = tuple(observer_holders)
+        sticky_caches = (self.__sticky_events,) if self.__sticky_events \
+          .is_sticky(None if by_name else event.sender, event.name) else ()
+        
+        parent = self.__parent
+        if parent == None or (observer_holders and self.__propagation == \
+                              ObserverRegistry.STOP_PROPAGATION):
+            return observer_holders, sticky_caches
+        if by_name:
+            parent_holders, parent_sticky_caches = \
+              parent.__get_name_entry(event)
+        else:
+            parent_holders, parent_sticky_caches = \
+              parent._get_dispatch_entry(event)
+        if self.__propagation == ObserverRegistry.PARENT_FIRST:
+            return parent_holders + observer_holders, \
+              parent_sticky_caches + sticky_caches
+        return observer_holders + parent_holders, \
+          sticky_caches + parent_sticky_caches
+    
+    def _count_send(self, sender, name):
+        """
+        Count an event sent if counting is enabled.
+        """
+        
+        send_counts = self.__send_counts
+        if send_counts != None:
+            key = (sender, name)
+            if key not in send_counts and \
+              len(send_counts) >= self.__send_counts_capacity:
+                # Forget the keys least sent so their senders are freed:
+                send_counts = self.__send_counts = Counter(dict( \
+                  send_counts.most_common(self.__send_counts_capacity // 2)))
+            send_counts[key] += 1
+            
+    def has_observers(self, sender, name):
+        """
+        Tell if an event would be received by at least one observer of the
+        registry or of its ancestors. The answer does not depend on the number
+        of observers.
+        @param sender: The sender of the event.
+        @param name: The name of the event.
+        """
+        
+        if self.__has_chain_sender_entries(sender, name):
+            registry = self
+            while registry != None:
+                if registry._has_local_observers(sender, name):
+                    return True
+                registry = registry.__parent
+            return False
+        return bool(self.__get_name_entry(_EventKey(sender, name))[0])
+    
+    def _has_local_observers(self, sender, name):
+        """
+        Tell if an event has observers in this registry.
+        """
+        
+        for registry in self.__registries:
+            if registry._has_observers(sender, name):
+                return True
+        return False
+    
+    def _is_sticky(self, sender, name):
+        """
+        Tell if this registry retains the events with sender and name.
+        """
+        
+        return self.__sticky_events.is_sticky(sender, name)
+    
+    def _must_dispatch(self, sender, name):
+        """
+        Tell if an event must be created to be sent: it has observers or it
+        is retained by the chain of registries.
+        """
+        
+        if self.__has_chain_sender_entries(sender, name):
+            return True
+        observer_holders, sticky_caches = \
+          self.__get_name_entry(_EventKey(sender, name))
+        return bool(observer_holders or sticky_caches)
+    
+    def _invalidate_dispatch_cache(self):
+        """
+        Forget the cached observers of this registry and of the registries
+        having it as ancestor. Must be called when the observers change.
+        """
+        
+        self.__dispatch_cache.clear()
+        self.__chain_senders = None
+        for child in self.__children:
+            child._invalidate_dispatch_cache()
+            
+    def __remove_dead_observers(self):
+        """
+        Remove the dead weakref observers of the chain of registries.
+        """
+        
+        registry = self
+        while registry:
+            registry.remove_observer(None)
+            registry = registry.__parent
+    
+    def _notify(self, observer_holder, event, errors=None):
+        """
+        Call an observer holder with an event unless its registration options
+        prevent it.
+        @param errors: The list of the errors to raise after the observers
+        are notified with ERRORS_RAISE_AFTER. Optional.
+        @return: The value returned by the observer or _NOT_CALLED.
+        """
+        
+        sampler = observer_holder.sampler
+        if sampler != None:
+            if isinstance(event, EventBatch):
+                event = sampler.select(event)
+                if event == None:
+                    return _NOT_CALLED
+            elif not sampler.accepts(event):
+                return _NOT_CALLED
+        breaker = observer_holder.breaker
+        if breaker != None and not breaker.allows():
+            return _NOT_CALLED
+        throttle = observer_holder.throttle
+        if throttle != None:
+            if not throttle.acquire():
+                throttle.suppress(event)
+                return _NOT_CALLED
+            if throttle.pending:
+                if throttle.policy == ObserverRegistry.RATE_QUEUE:
+                    # Deliver the queued events first:
+                    throttle.pending.append(event)
+                    self.__deliver_pending(observer_holder, 1, errors)
+                    return _NOT_CALLED
+                throttle.pending.clear()
+        if observer_holder.remaining_calls != None and \
+          not self._consume_call(observer_holder):
+            return _NOT_CALLED
+        if breaker == None and \
+          self.error_policy == ObserverRegistry.ERRORS_RAISE:
+            return observer_holder(event)
+        return self.__call_holder(observer_holder, event, errors)
+    
+    def __call_holder(self, observer_holder, event, errors):
+        """
+        Call an observer holder, reporting to its breaker and handling its
+        exceptions according to the error policy.
+        @return: The value returned by the observer or _NOT_CALLED if it
+        raised an exception.
+        """
+        
+        breaker = observer_holder.breaker
+        try:
+            if breaker == None:
+                return observer_holder(event)
+            start = _monotonic()
+            try:
+                result = observer_holder(event)
+            except Exception:
+                breaker.record(_monotonic() - start, True)
+                raise
+            breaker.record(_monotonic() - start, False)
+            return result
+        except Exception, exception:
+            error_policy = self.error_policy
+            if error_policy == ObserverRegistry.ERRORS_RAISE:
+                raise
+            error = (observer_holder.observer, event, exception)
+            if error_policy == ObserverRegistry.ERRORS_LOG:
+                logging.getLogger(__name__).exception("Error notifying %r " \
+                  "of %r.", error[0], event)
+            elif error_policy == ObserverRegistry.ERRORS_COLLECT:
+                self.__errors.append(error)
+            elif errors != None:
+                errors.append(error)
+            else:
+                raise EventDispatchError([error])
+            return _NOT_CALLED
+    
+    def __deliver_pending(self, observer_holder, reserved=0, errors=None):
+        """
+        Deliver the pending events of a throttled observer holder as long as
+        its rate allows.
+        @param reserved: The number of tokens already taken.
+        @param errors: The list of the errors to raise after the observers
+        are notified with ERRORS_RAISE_AFTER. Optional.
+        @return: The number of events delivered.
+        """
+        
+        throttle = observer_holder.throttle
+        breaker = observer_holder.breaker
+        count = 0
+        # A call may open the breaker, the rest stays pending:
+        while throttle.pending and \
+          (breaker == None or breaker.allows()) and \
+          (reserved > 0 or throttle.acquire()):
+            reserved = 0
+            count += 1
+            event = throttle.pending.popleft()
+            if observer_holder.remaining_calls == None or \
+              self._consume_call(observer_holder):
+                self.__call_holder(observer_holder, event, errors)
+        return count
+        
+    def flush_throttled(self):
+        """
+        Deliver the events kept for the observers registered with a rate as
+        long as their rate allows. Call it periodically with RATE_KEEP_LATEST
+        or RATE_QUEUE so the last events are not held indefinitely.
+        @return: The number of events delivered.
+        """
+        
+        return sum(self.__deliver_pending(observer_holder) for \
+                   observer_holder in self.__throttled_holders.keys() \
+                   if observer_holder.throttle.pending)
+        
+    def suppressed_count(self, observer):
+        """
+        Get the number of events an observer registered with a rate did not
+        receive when they were sent because of its rate.
+        @param observer: The observer.
+        @return: The count or None if the observer has no rate.
+        """
+        
+        observer_holder = self.__throttled_holders.get( \
+          _NullObserverHolder(observer))
+        return observer_holder.throttle.suppressed if observer_holder \
+          else None
+    
+    def breaker_state(self, observer):
+        """
+        Get the state of the breaker of an observer.
+        @param observer: The observer.
+        @return: CircuitBreaker.CLOSED, OPEN or HALF_OPEN or None if the
+        observer has no breaker.
+        """
+        
+        observer_holder = self.__breaker_holders.get( \
+          _NullObserverHolder(observer))
+        return observer_holder.breaker.state if observer_holder else None
+    
+    def take_errors(self):
+        """
+        Get and forget the errors kept with ERRORS_COLLECT. The 1024 most
+        recent errors are kept.
+        @return: The list of (observer, event, exception).
+        """
+        
+        errors = []
+        while self.__errors:
+            errors.append(self.__errors.popleft())
+        return errors
+                
+    def remove_observer(self, observer):
+        """
+        Remove an observer from the registry.
+        @param observer: The observer to remove. The same observer as for 
+        add_observer.
+        """
+        
+        observer_holder = _NullObserverHolder(observer) if observer else None
+        for registry in self.__registries:
+            registry._remove_observer_imp(observer_holder)
+        self._invalidate_dispatch_cache()
+        
+        # Forget the counted holders removed:
+        if self.__counted_holders:
+            if observer_holder:
+                counted_holder = self.__counted_holders.pop(observer_holder, \
+                                                            None)
+                if counted_holder:
+                    counted_holder.registration = None
+            else:
+                for counted_holder in self.__counted_holders.keys():
+                    if counted_holder.is_dead:
+                        del self.__counted_holders[counted_holder]
+        
+        # Forget the throttled holders removed:
+        if self.__throttled_holders:
+            if observer_holder:
+                self.__throttled_holders.pop(observer_holder, None)
+            else:
+                for throttled_holder in self.__throttled_holders.keys():
+                    if throttled_holder.is_dead:
+                        del self.__throttled_holders[throttled_holder]
+        
+        # Forget the holders with a breaker removed:
+        if self.__breaker_holders:
+            if observer_holder:
+                self.__breaker_holders.pop(observer_holder, None)
+            else:
+                for breaker_holder in self.__breaker_holders.keys():
+                    if breaker_holder.is_dead:
+                        del self.__breaker_holders[breaker_holder]
+        
+    def clear(self):
+        """
+        Remove all the observers.
+        """
+        
+        for registry in self.__registries:
+            registry._clear_imp()
+        self._invalidate_dispatch_cache()
+        for counted_holder in self.__counted_holders:
+            counted_holder.registration = None
+        self.__counted_holders.clear()
+        self.__throttled_holders.clear()
+        self.__breaker_holders.clear()
+        
+    def count_sends(self, enabled=True, capacity=1024):
+        """
+        Start or stop counting the events sent for each (sender, name). The
+        counts are reported by stats. Stopping forgets the counts.
+        @param enabled: True to count. Optional.
+        @param capacity: The maximum number of (sender, name) counted. When
+        it is reached, the half least sent are forgotten, so the hot keys are
+        kept and the senders sent rarely are not kept alive. Optional.
+        """
+        
+        assert capacity > 0, "The capacity must be positive."
+        self.__send_counts = Counter() if enabled else None
+        self.__send_counts_capacity = capacity
+        
+    def stats(self, top=10):
+        """
+        Report the content of the registry. Useful to monitor the registry and
+        to find leaks.
+        @param top: The number of items in the top lists. Optional.
+        @return: A dictionary with the keys:
+          - subscriptions: the number of observers by type of registration;
+          - largest_fan_out: by type of registration, the top (key, number of
+            observers) of the senders, names or (sender, name);
+          - dead_observers: the number of weakref observers that are dead
+            but not removed yet;
+          - hot_keys: the top ((sender, name), number of events sent) or None
+            if count_sends is not enabled;
+          - hard_ref_observers: the top (observer, bytes) of the observers
+            held by a strong reference, by the size of the observer and of
+            the objects it references directly;
+          - dispatch_cache_entries: the number of names cached;
+          - sticky_events: the number of sticky events retained;
+          - breakers: the number of observers with a breaker by state;
+          - bytes: the approximate memory used by the registry.
+        """
+        
+        subscriptions = Counter()
+        fan_outs = dict()
+        dead_observers = 0
+        hard_ref_observers = []
+        size = 0
+        dispatch_cache_entries = 0
+        sticky_events = 0
+        send_counts = Counter()
+        breakers = Counter()
+        for registry in self._get_stats_registries():
+            for delegate in registry.__registries:
+                # Only the delegates keeping their holders in _registry can
+                # report them:
+                if not hasattr(delegate, "_registry"):
+                    continue
+                kind = delegate._kind if delegate._kind \
+                  else delegate.__class__.__name__
+                fan_out = fan_outs.setdefault(kind, Counter())
+                size += sys.getsizeof(delegate._registry)
+                for key, set_of_holders in delegate._iter_holders_by_key():
+                    if key != None:
+                        fan_out[key] += len(set_of_holders)
+                        size += sys.getsizeof(set_of_holders)
+                    if set_of_holders:
+                        subscriptions[kind] += len(set_of_holders)
+                    for observer_holder in set_of_holders:
+                        size += _object_size(observer_holder)
+                        if observer_holder.breaker != None:
+                            breakers[observer_holder.breaker.state] += 1
+                        if observer_holder.is_dead:
+                            dead_observers += 1
+                        elif isinstance(observer_holder, \
+                                        _HardRefObserverHolder):
+                            observer = observer_holder.observer
+                            hard_ref_observers.append((observer, \
+                              _object_size(observer) + sum( \
+                              _object_size(referent) for referent in \
+                              gc.get_referents(observer))))
+            size += sys.getsizeof(registry.__dispatch_cache)
+            dispatch_cache_entries += len(registry.__dispatch_cache)
+            sticky_events += len(registry.__sticky_events)
+            if registry.__send_counts != None:
+                send_counts.update(registry.__send_counts)
+        hard_ref_observers.sort(key=lambda item: item[1], reverse=True)
+        return {"subscriptions": dict(subscriptions),
+                "largest_fan_out": dict((kind, fan_out.most_common(top)) \
+                                        for kind, fan_out \
+                                        in fan_outs.iteritems() if fan_out),
+                "dead_observers": dead_observers,
+                "hot_keys": send_counts.most_common(top) \
+                  if self.__send_counts != None else None,
+                "hard_ref_observers": hard_ref_observers[:top],
+                "dispatch_cache_entries": dispatch_cache_entries,
+                "sticky_events": sticky_events,
+                "breakers": dict(breakers),
+                "bytes": size}
+    
+    def _get_stats_registries(self):
+        """
+        The registries reported by stats.
+        """
+        
+        return [self]
+        
+    def make_sticky(self, named, sent_by=None):
+        """
+        Retain the last event sent with a name, optionally only for a specific
+        sender, so it can be replayed to observers added later.
+        @param named: The name of the event.
+        @param sent_by: The sender of the event. None means any sender.
+        Optional.
+        """
+        
+        _validate_event_name(named)
+        assert named != None, "Sticky events must have a name."
+        self.__sticky_events.add_sticky(sent_by, named)
+        self._invalidate_dispatch_cache()
+        
+    def remove_sticky(self, named, sent_by=None):
+        """
+        Stop retaining the events made sticky by make_sticky. The events
+        retained that are no longer sticky are forgotten.
+        @param named: The name of the event.
+        @param sent_by: The sender of the event. None means any sender.
+        Optional.
+        """
+        
+        self.__sticky_events.remove_sticky(sent_by, named)
+        self._invalidate_dispatch_cache()
+        
+    def __replay(self, observer_holder, sent_by, named):
+        """
+        Send the sticky events matching a registration to a new observer.
+        """
+        
+        for event in self._get_sticky_events(sent_by, named):
+            self._notify(observer_holder, event)
+            
+    def _get_sticky_events(self, sent_by, named):
+        """
+        Get the sticky events to replay to an observer registered with
+        sent_by and named.
+        """
+        
+        return self.__sticky_events.get(sent_by, named)
+        
+    def _consume_call(self, observer_holder):
+        """
+        Count a call for an observer registered with max_calls. The observer
+        is retired from the registry holding it before being called so nested
+        sends cannot reach it again.
+        @param observer_holder: The _ObserverHolder about to be called.
+        @return: False if the observer must not be called.
+        """
+        
+        if observer_holder.registration == None:
+            # Removed or retired while the event was dispatched:
+            return False
+        observer_holder.remaining_calls -= 1
+        if observer_holder.remaining_calls == 0:
+            registry, delegate, sent_by, named = observer_holder.registration
+            delegate._discard_imp(observer_holder, sent_by, named)
+            del registry.__counted_holders[observer_holder]
+            registry._invalidate_dispatch_cache()
+            observer_holder.registration = None
+        return True
+        
+#==============================================================================
+# _ObserverRegistryDelegate
+#==============================================================================
+
+class _ObserverRegistryDelegate(object):
+    """
+    An abstract delegate class for ObserverRegistry representing in a type
+    hierarchy of the different type of observer registration.
+    """
+    
+    _kind = None
+    """
+    The name of the type of registration reported by ObserverRegistry.stats.
+    """
+    
+    _by_sender = True
+    """
+    Tell if the observers found depend on the sender of the events.
+    """
+    
+    def __init__(self):
+        if self.__class__ == _ObserverRegistryDelegate:
+            raise TypeError(self.__class__.__name__ + " is an abstract class" \
+              + " that cannot be instantiated.")
+    
+    def _add_observer_cond(self, sent_by, named):
+        """
+        Specify if a derived class accept this kind of observer. Must be 
+        overridden.
+        """
+        
+        raise NotImplementedError()
+
+    def _add_observer_imp(self, observer_holder, sent_by, named):
+        """
+        Add an already validated observer holder. Must be overridden.
+        """
+        
+        raise NotImplementedError()
+    
+    def _get_observer_holders(self, event):
+        """
+        Method used to get all the observer holders of an event. Must be 
+        overridden.
+        """
+
+        raise NotImplementedError()
+    
+    def _remove_observer_imp(self, observer_holder):
+        """
+        Default implementation of remove an observer_holder.
+        @param observer_holder: An _ObserverHolder or None to delete dead
+        observer holders.
+        """
+        
+        new_dict = dict()
+        for key, set_of_holders in self._registry.iteritems():
+            if observer_holder:
+                set_of_holders.discard(observer_holder)
+            else:
+                holders_to_remove = set()
+                for o in set_of_holders:
+                    if o.is_dead:
+                        holders_to_remove.add(o)
+                set_of_holders -= holders_to_remove
+            if len(set_of_holders) > 0:
+                new_dict[key] = set_of_holders
+        # Replaced at once, the lookups made without lock never see an
+        # empty registry:
+        self._registry = new_dict
+        
+    def _discard_imp(self, observer_holder, sent_by, named):
+        """
+        Default implementation to remove a single observer holder registered
+        with sent_by and named. Only the set of the key is modified.
+        """
+        
+        key = self._registration_key(sent_by, named)
+        set_of_holders = self._registry.get(key)
+        if set_of_holders != None:
+            set_of_holders.discard(observer_holder)
+            if not set_of_holders:
+                del self._registry[key]
+    
+    def _registration_key(self, sent_by, named):
+        """
+        The key used in the registry for an observer registered with sent_by
+        and named. Must be overridden to use _discard_imp.
+        """
+        
+        raise NotImplementedError()
+    
+    def _iter_holders_by_key(self):
+        """
+        Default implementation to iterate over the (key, set of observer
+        holders) of the registry.
+        """
+        
+        return self._registry.iteritems()
+    
+    def _sender_keys(self):
+        """
+        Get the containers of the senders observed for all their events and
+        of the (sender, name) keys observed, for a delegate with _by_sender.
+        Adding a sender or a key must invalidate the dispatch cache.
+        @return: A tuple (senders, keys) or None if unknown.
+        """
+        
+        return None
+    
+    def _has_observers(self, sender, name):
+        """
+        Default implementation to tell if there are observers for an event
+        sent with sender and name.
+        """
+        
+        return bool(self._get_observer_holders(Event(sender, name)))
+        
+    def _clear_imp(self):
+        """
+        Default implementation to remove all observers.
+        """
+        
+        self._registry.clear()
+    
+
 class _AllEventsObserverRegistryDelegate(_ObserverRegistryDelegate):
     """
     A registry for observers who want to be notified of all events.
     """
     
+    _kind = "all events"
+    _by_sender = False
+    
     def __init__(self):
         self._registry = set()
 
@@ -222,6 +1584,15 @@ class _AllEventsObserverRegistryDelegate(_ObserverRegistryDelegate):
     def _get_observer_holders(self, event):
         return self._registry
         
+    def _has_observers(self, sender, name):
+        return len(self._registry) > 0
+        
+    def _discard_imp(self, observer_holder, sent_by, named):
+        self._registry.discard(observer_holder)
+        
+    def _iter_holders_by_key(self):
+        return [(None, self._registry)]
+        
     def _remove_observer_imp(self, observer_holder):
         if observer_holder:
             self._registry.discard(observer_holder)
@@ -237,6 +1608,8 @@ class _SendersObserverRegistryDelegate(_ObserverRegistryDelegate):
     A registry for observers who want to be notified of all events sent by a
     specific sender.
     """
+    
+    _kind = "senders"
 
     def __init__(self):
         self._registry = dict()
@@ -249,14 +1622,26 @@ class _SendersObserverRegistryDelegate(_ObserverRegistryDelegate):
             self._registry[sent_by] = set()
         self._registry[sent_by].add(observer_holder)
 
+    def _registration_key(self, sent_by, named):
+        return sent_by
+
     def _get_observer_holders(self, event):
         return self._registry.get(event.sender, frozenset())
+    
+    def _has_observers(self, sender, name):
+        return sender in self._registry
+    
+    def _sender_keys(self):
+        return self._registry, ()
         
 class _NamesObserverRegistryDelegate(_ObserverRegistryDelegate):
     """
     A registry for observers who want to be notified of all events sent with a
     specific name.
     """
+    
+    _kind = "names"
+    _by_sender = False
 
     def __init__(self):
         self._registry = dict()
@@ -269,8 +1654,14 @@ class _NamesObserverRegistryDelegate(_ObserverRegistryDelegate):
             self._registry[named] = set()
         self._registry[named].add(observer_holder)
 
+    def _registration_key(self, sent_by, named):
+        return named
+
     def _get_observer_holders(self, event):
         return self._registry.get(event.name, frozenset())
+    
+    def _has_observers(self, sender, name):
+        return name in self._registry
         
 class _SendersAndNamesObserverRegistryDelegate \
         (_ObserverRegistryDelegate):
@@ -278,6 +1669,8 @@ class _SendersAndNamesObserverRegistryDelegate \
     A registry for observers who want to be notified of all events sent by a
     specific sender under a certain name.
     """
+    
+    _kind = "senders and names"
 
     def __init__(self):
         self._registry = dict()
@@ -291,244 +1684,1137 @@ class _SendersAndNamesObserverRegistryDelegate \
             self._registry[key] = set()
         self._registry[key].add(observer_holder)
 
+    def _registration_key(self, sent_by, named):
+        return (sent_by, named)
+
     def _get_observer_holders(self, event):
         key = (event.sender, event.name)
         return self._registry.get(key, frozenset())
+    
+    def _has_observers(self, sender, name):
+        return (sender, name) in self._registry
+    
+    def _sender_keys(self):
+        return (), self._registry
         
-# Create the default registry:
-ObserverRegistry.default_registry = ObserverRegistry()
-
 #==============================================================================
-# _ObserverHolder
+# ShardedObserverRegistry
 #==============================================================================
 
-class _ObserverHolder(object):
+class ShardedObserverRegistry(ObserverRegistry):
     """
-    An abstract class encapsulating of observer so they all can be treated
-    polymorphically.
+    A thread safe registry partitioning the observers in shards by a hash of
+    the name or of the (sender, name) of the events they observe. Each shard
+    has its own lock and observers so sending events to unrelated names
+    never contend. The observers that cannot be partitioned, like the
+    observers of all events, are held once by the registry itself and are
+    shared by all the shards.
     """
     
-    def __new__(cls, observer, method="__call__"):
+    BY_NAME = "name"
+    """
+    Partition the observers by the name of the events.
+    """
+    
+    BY_SENDER_AND_NAME = "sender and name"
+    """
+    Partition the observers by the sender and the name of the events.
+    """
+    
+    def __init__(self, shards=8, shard_by=BY_NAME, workers=False, \
+                 sticky_capacity=1024):
         """
-        The constructor of the class. Will create the appropriate instance
-        type based on observer.
+        Create a new sharded registry.
+        @param shards: The number of shards. Optional.
+        @param shard_by: BY_NAME or BY_SENDER_AND_NAME. Optional.
+        @param workers: If True, each shard has a thread notifying the
+        observers of the events sent. send_event returns without waiting for
+        the observers. Optional.
+        @param sticky_capacity: The maximum number of sticky events retained
+        by each shard. Optional.
         """
-
-        if cls == _NullObserverHolder:
-            return object.__new__(cls, observer)
         
-        for delegate_class in cls.__subclasses__():
-            if delegate_class == _NullObserverHolder:
-                continue
-            is_holder_or_class = delegate_class._is_holder_or_class(observer, \
-                                                                    method) 
-            if is_holder_or_class:
-                class_type = delegate_class if is_holder_or_class is True \
-                  else is_holder_or_class
-                return object.__new__(class_type, observer, method)
-        raise ValueError("Observer is not callable with 1 or 0 argument " + \
-                         "or an IObserver.")
+        assert shards > 0, "The number of shards must be positive."
+        assert shard_by in (ShardedObserverRegistry.BY_NAME, \
+                            ShardedObserverRegistry.BY_SENDER_AND_NAME), \
+                            "Unknown partitioning."
+        super(ShardedObserverRegistry, self).__init__(sticky_capacity)
+        self.__shard_by = shard_by
+        self.__shards = [_Shard(ObserverRegistry(sticky_capacity, self)) \
+                         for i in range(shards)]
+        # The lock of each registry:
+        self.__locks = dict((shard.registry, shard.lock) \
+                            for shard in self.__shards)
+        # The shards holding each observer, None standing for the registry
+        # itself, so changing an observer only locks its shards:
+        self.__observer_shards = dict()
+        self.__observer_shards_lock = threading.Lock()
+        self.__observer_shards_purge_size = 64
+        if workers:
+            for shard in self.__shards:
+                shard.start_worker(self)
+                
+    def add_observer(self, observer, sent_by=None, named=None, \
+                     method="__call__", **options):
+        self._validate_registration_name(named)
+        self.remove_observer(observer)
+        shard = self.__shard_for_registration(sent_by, named)
+        if shard:
+            with shard.lock:
+                shard.registry.add_observer(observer, sent_by, named, method, \
+                                            **options)
+        else:
+            with _AllLocks(self.__shards):
+                super(ShardedObserverRegistry, self).add_observer(observer, \
+                  sent_by, named, method, **options)
+        self.__set_observer_shards(observer, [shard])
+    add_observer.__doc__ = ObserverRegistry.add_observer.__doc__
+    
+    def _add_declared_observer(self, observer, table):
+        self.remove_observer(observer)
+        keys_by_shard = dict()
+        for sent_by, named in table.keys:
+            shard = self.__shard_for_registration(sent_by, named)
+            keys_by_shard.setdefault(shard, []).append((sent_by, named))
         
-    def __init__(self, method):
-        if self.__class__ == _ObserverHolder:
-            raise TypeError(self.__class__.__name__ + " is an abstract class" \
-              + " that cannot be instantiated.")
-        self._hash = hash(self.observer)
-        self.method = method
+        # One holder by shard with only the keys of the shard, so an event
+        # never reaches the same instance through two registries:
+        for shard, keys in keys_by_shard.iteritems():
+            observer_holder = _DeclaredObserverHolder(observer, \
+                                                      table.restricted(keys))
+            if shard:
+                with shard.lock:
+                    shard.registry._add_declared_holder(observer_holder)
+            else:
+                with _AllLocks(self.__shards):
+                    super(ShardedObserverRegistry, self) \
+                      ._add_declared_holder(observer_holder)
+        self.__set_observer_shards(observer, keys_by_shard.keys())
     
-    def __call__(self, event):
+    def send_event(self, event_or_sender, name=None, info=None, \
+                   info_factory=None):
         """
-        Every observer holder must be able to call the observer they are
-        holding.
+        Send an event to all observers registered for the event. With workers,
+        the observers are notified by the worker of the shard of the event.
+        @param event_or_sender: The event to send of type Event or the
+        sender of the event.
+        @param name: The name of the event if event_or_sender is not an
+        Event.
+        @param info: Give more information about an event if event_or_sender 
+        is not an Event. Optional. 
+        @param info_factory: A function without argument returning the info,
+        in place of info. Optional.
         """
-
-        raise NotImplementedError()
+        
+        if not isinstance(event_or_sender, Event) and \
+          not self._must_dispatch(event_or_sender, name):
+            Event._validate_sender_name(event_or_sender, name)
+            self._count_send(event_or_sender, name)
+            return
+        
+        event = self._make_event(event_or_sender, name, info, info_factory)
+        if self._defer(event):
+            return
+        shard = self.__shard_for_event(event.sender, event.name)
+        if shard.queue:
+            shard.queue.put(event)
+        else:
+            super(ShardedObserverRegistry, self).send_event(event)
     
-    def __eq__(self, other):
-        if isinstance(other, _ObserverHolder):
-            if self.is_dead:
-                return other.is_dead
-            return self.observer == other.observer
-        return False
+    def remove_observer(self, observer):
+        if observer:
+            with self.__observer_shards_lock:
+                shards = self.__observer_shards.pop( \
+                  _NullObserverHolder(observer), ())
+        else:
+            # The dead observers may be in any shard:
+            shards = self.__shards + [None]
+        for shard in shards:
+            if shard:
+                with shard.lock:
+                    shard.registry.remove_observer(observer)
+            else:
+                with _AllLocks(self.__shards):
+                    super(ShardedObserverRegistry, self) \
+                      .remove_observer(observer)
+    remove_observer.__doc__ = ObserverRegistry.remove_observer.__doc__
     
-    def __ne__(self, other):
-        return not (self == other)
+    def clear(self):
+        for shard in self.__shards:
+            with shard.lock:
+                shard.registry.clear()
+        with _AllLocks(self.__shards):
+            super(ShardedObserverRegistry, self).clear()
+        with self.__observer_shards_lock:
+            self.__observer_shards.clear()
+    clear.__doc__ = ObserverRegistry.clear.__doc__
     
-    def __hash__(self):
-        return self._hash
+    def make_sticky(self, named, sent_by=None):
+        for shard in self.__shards_for_sticky(named, sent_by):
+            with shard.lock:
+                shard.registry.make_sticky(named, sent_by)
+    make_sticky.__doc__ = ObserverRegistry.make_sticky.__doc__
     
-    @classmethod
-    def _is_holder_or_class(cls, observer, method):
+    def remove_sticky(self, named, sent_by=None):
+        for shard in self.__shards_for_sticky(named, sent_by):
+            with shard.lock:
+                shard.registry.remove_sticky(named, sent_by)
+    remove_sticky.__doc__ = ObserverRegistry.remove_sticky.__doc__
+    
+    def flush_throttled(self):
+        # The observers are not called with the lock of their shard:
+        return sum(shard.registry.flush_throttled() for shard \
+                   in self.__shards) + \
+          super(ShardedObserverRegistry, self).flush_throttled()
+    flush_throttled.__doc__ = ObserverRegistry.flush_throttled.__doc__
+    
+    def suppressed_count(self, observer):
+        for shard in self.__shards:
+            count = shard.registry.suppressed_count(observer)
+            if count != None:
+                return count
+        return super(ShardedObserverRegistry, self).suppressed_count(observer)
+    suppressed_count.__doc__ = ObserverRegistry.suppressed_count.__doc__
+    
+    def breaker_state(self, observer):
+        for shard in self.__shards:
+            state = shard.registry.breaker_state(observer)
+            if state != None:
+                return state
+        return super(ShardedObserverRegistry, self).breaker_state(observer)
+    breaker_state.__doc__ = ObserverRegistry.breaker_state.__doc__
+    
+    def join(self):
         """
-        Method derived class must implement to tell if they can hold this
-        type of observer. They may return True or false (truth as Python 
-        defines it) or the class to be used.
+        Wait until the workers have notified the observers of all the events
+        sent.
         """
-
-        raise NotImplementedError()
-
-    @property
-    def is_dead(self):
+        
+        for shard in self.__shards:
+            if shard.queue:
+                shard.queue.join()
+                
+    def close(self):
         """
-        Property telling if an observer is still alive. This method is used to
-        manage weak references that may be gone.
+        Stop the workers after they have notified the observers of all the
+        events sent. The events sent after are notified synchronously.
         """
-
-        raise NotImplementedError()
+        
+        for shard in self.__shards:
+            shard.stop_worker()
     
-    @property
-    def observer(self):
+    def has_observers(self, sender, name):
+        return self.__shard_for_event(sender, name).registry \
+          ._has_local_observers(sender, name) or \
+          self._has_local_observers(sender, name)
+    has_observers.__doc__ = ObserverRegistry.has_observers.__doc__
+    
+    def _must_dispatch(self, sender, name):
+        return self.has_observers(sender, name) or \
+          self.__shard_for_event(sender, name).registry._is_sticky(sender, \
+                                                                   name)
+    
+    def _get_observer_holders(self, event):
+        self._count_send(event.sender, event.name)
+        shard = self.__shard_for_event(event.sender, event.name)
+        with shard.lock:
+            return shard.registry._get_observer_holders(event)
+        
+    def _get_batch_holders(self, batch, index):
+        sender = batch.senders[index]
+        self._count_send(sender, batch.name)
+        shard = self.__shard_for_event(sender, batch.name)
+        with shard.lock:
+            return shard.registry._get_batch_holders(batch, index)
+        
+    def _get_stats_registries(self):
+        return [self] + [shard.registry for shard in self.__shards]
+        
+    def _get_sticky_events(self, sent_by, named):
+        events = []
+        for shard in self.__shards:
+            with shard.lock:
+                events.extend(shard.registry._get_sticky_events(sent_by, \
+                                                                named))
+        return events
+        
+    def _consume_call(self, observer_holder):
+        registration = observer_holder.registration
+        if registration == None:
+            return False
+        lock = self.__locks.get(registration[0])
+        with lock if lock else _AllLocks(self.__shards):
+            return super(ShardedObserverRegistry, self) \
+              ._consume_call(observer_holder)
+        
+    def __set_observer_shards(self, observer, shards):
         """
-        Property to get access the observer the holder is holding.
+        Remember the shards holding an observer, None standing for the
+        registry itself.
         """
-
-        raise NotImplementedError()
-
-    @staticmethod
-    def _is_zero_param(info):
-        if info:
-            min_arg = 0
-            if not info["is_function"]:
-                min_arg = 1
-            return info["len_agr_spec"] == min_arg
-        return False
+        
+        try:
+            key = _ObserverShardsKey(observer)
+        except TypeError:
+            # Held by a strong reference by the registry too:
+            key = _NullObserverHolder(observer)
+        with self.__observer_shards_lock:
+            observer_shards = self.__observer_shards
+            # Forget the dead observers from time to time:
+            if len(observer_shards) >= self.__observer_shards_purge_size:
+                for dead_key in [i for i in observer_shards if i.is_dead]:
+                    del observer_shards[dead_key]
+                self.__observer_shards_purge_size = \
+                  max(64, 2 * len(observer_shards))
+            observer_shards[key] = list(shards)
     
-    @staticmethod
-    def _is_one_param(info):
-        if info:
-            min_arg = 1
-            if not info["is_function"]:
-                min_arg = 2
-            return (info["len_agr_spec"] >= min_arg \
-              and info["len_agr_spec"] - info["len_arg_spec_defaults"] \
-                <= min_arg) or info["varargs"]
-        return False
-
-    @staticmethod
-    def _callable_param_info(observer, method):
+    def __shard_for_registration(self, sent_by, named):
         """
-        A method giving information about the parameters of a callable.
+        Get the shard of a registration or None if the registration is
+        held by the registry itself.
         """
-
-        info = dict()
-        if not isinstance(observer, types.BuiltinFunctionType):
-            if not (isinstance(observer, types.FunctionType) \
-                    and method == "__call__"):
-                if hasattr(observer, method):
-                    observer = getattr(observer, method)
-                else:
-                    return info
-            if callable(observer):
-                info["is_function"] = isinstance(observer, types.FunctionType)
-                arg_spec = inspect.getargspec(observer)
-                info["len_agr_spec"] = len(arg_spec.args)
-                info["len_arg_spec_defaults"] = 0 if not arg_spec.defaults \
-                    else len(arg_spec.defaults)
-                info["varargs"] = bool(arg_spec.varargs)
-        return info
-    
-    @staticmethod
-    def _is_function(o):
-        return isinstance(o, (types.FunctionType, types.BuiltinFunctionType))
+        
+        if named == None:
+            return None
+        if self.__shard_by == ShardedObserverRegistry.BY_NAME:
+            return self.__shards[hash(named) % len(self.__shards)]
+        if sent_by == None:
+            return None
+        return self.__shards[hash((sent_by, named)) % len(self.__shards)]
+        
+    def __shard_for_event(self, sender, name):
+        if self.__shard_by == ShardedObserverRegistry.BY_NAME:
+            key = name
+        else:
+            key = (sender, name)
+        return self.__shards[hash(key) % len(self.__shards)]
     
-class _NullObserverHolder(_ObserverHolder):
+    def __shards_for_sticky(self, named, sent_by):
+        _validate_event_name(named)
+        if self.__shard_by == ShardedObserverRegistry.BY_SENDER_AND_NAME \
+          and sent_by == None:
+            return self.__shards
+        return [self.__shard_for_registration(sent_by, named)]
+        
+class _Shard(object):
     """
-    An null observer just needed to remove observers.
+    A partition of a ShardedObserverRegistry. The parent of the registry of
+    a shard is the ShardedObserverRegistry.
     """
-    def __init__(self, observer):
-        self.__observer = observer
-        super(_NullObserverHolder, self).__init__("")
-        
-    def __call__(self, event):
-        pass
     
-    @property
-    def is_dead(self):
-        return False
+    def __init__(self, registry):
+        self.registry = registry
+        self.lock = threading.RLock()
+        self.queue = None
+        self.__thread = None
+        
+    def start_worker(self, sharded_registry):
+        self.queue = Queue.Queue()
+        self.__thread = threading.Thread(target=self.__work, \
+                                         args=(sharded_registry, self.queue))
+        self.__thread.daemon = True
+        self.__thread.start()
+        
+    def stop_worker(self):
+        if self.queue:
+            queue, self.queue = self.queue, None
+            queue.put(None)
+            self.__thread.join()
+            self.__thread = None
     
-    @property
-    def observer(self):
-        return self.__observer
-
-
+    @staticmethod
+    def __work(sharded_registry, queue):
+        while True:
+            event = queue.get()
+            try:
+                if event == None:
+                    return
+                ObserverRegistry.send_event(sharded_registry, event)
+            except Exception:
+                logging.getLogger(__name__).exception("Error notifying " \
+                  "the observers of %r.", event)
+            finally:
+                queue.task_done()
 
-class _IObserverHolder(_ObserverHolder):
+class _AllLocks(object):
     """
-    An abstract final holder for an IObserver to be scan by _ObserverHolder. 
-    Only direct subclasses of _ObserverHolder are scanned.
+    A context manager acquiring the locks of all the shards in order.
     """
-
-    @classmethod
-    def _is_holder_or_class(cls, observer, method):
-        if _IObserverWeakRefInstanceObserverHolder \
-          ._is_holder_or_class(observer, "receive_event"):
-            return _IObserverWeakRefInstanceObserverHolder
     
-    def __init__(self, observer):
-        raise TypeError(self.__class__.__name__ + " is an abstract final"
-          " class that cannot be instantiated.")
+    def __init__(self, shards):
+        self.__shards = shards
+        
+    def __enter__(self):
+        for shard in self.__shards:
+            shard.lock.acquire()
+            
+    def __exit__(self, exc_type, exc_value, traceback):
+        for shard in reversed(self.__shards):
+            shard.lock.release()
 
-class _WeakRefObserverHolder(_ObserverHolder):
+#==============================================================================
+# ScheduledEvent
+#==============================================================================
+
+class ScheduledEvent(object):
     """
-    An abstract holder using a weak reference.
+    An event scheduled with send_event_at or send_event_after.
     """
-
-    @classmethod
-    def _is_holder_or_class(cls, observer, method):
-        info = cls._callable_param_info(observer, method)
-        if info:
-            try:
-                weakref.ref(observer)
-            except:
-                return False
-            if cls._is_zero_param(info):
-                return _ZeroParamWeakRefObserverHolder
-            elif cls._is_one_param(info):
-                return _OneParamWeakRefObserverHolder
     
-    def __init__(self, observer, method):
-        if self.__class__ == _WeakRefObserverHolder:
-            raise TypeError(self.__class__.__name__ + " is an abstract class" \
-              + " that cannot be instantiated.")
-        self.weak_ref = weakref.ref(observer)
-        super(_WeakRefObserverHolder, self).__init__(method)
+    def __init__(self, scheduler, event, when):
+        self.event = event
+        """
+        The Event to send.
+        """
+        self.when = when
+        """
+        The time to send the event, as returned by time.time().
+        """
+        self.cancelled = False
+        self.sent = False
+        self.__scheduler = scheduler
     
-    def __call__(self, event):
-        raise NotImplementedError
-            
-    @property
-    def is_dead(self):
-        return self.weak_ref() == None
-
-    @property
-    def observer(self):
-        return self.weak_ref()
+    def cancel(self):
+        """
+        Cancel the event if it is not sent yet. The event is only marked as
+        cancelled and is dropped by the scheduler when it is due.
+        @return: True if the event is cancelled by this call.
+        """
+        
+        return self.__scheduler.cancel(self)
     
-class _ZeroParamWeakRefObserverHolder(_WeakRefObserverHolder):
+    def __repr__(self):
+        return "ScheduledEvent(" + repr(self.event) + ", " + \
+          repr(self.when) + ")"
+
+class _Scheduler(object):
     """
-    A concrete class of _WeakRefObserverHolder for a zero parameter callable.
+    The scheduled events of a registry in a heap ordered by time.
     """
-
-    def __init__(self, observer, method):
-        super(_ZeroParamWeakRefObserverHolder, self).__init__(observer, method)
     
-    def __call__(self, event):
-        observer = self.observer
-        if observer != None:
-            getattr(observer, self.method)()
+    def __init__(self, registry):
+        self.__registry = registry
+        # (deadline, sequence, ScheduledEvent), sequence keeping the order
+        # of the events scheduled at the same time:
+        self.__heap = []
+        self.__sequence = 0
+        self.__cancelled = 0
+        self.__condition = threading.Condition()
+        self.__thread = None
+        
+    def schedule(self, event, deadline, when, use_thread):
+        scheduled_event = ScheduledEvent(self, event, when)
+        with self.__condition:
+            self.__sequence += 1
+            heapq.heappush(self.__heap, (deadline, self.__sequence, \
+                                         scheduled_event))
+            if use_thread:
+                if self.__thread == None:
+                    self.__thread = threading.Thread(target=self.__run)
+                    self.__thread.daemon = True
+                    self.__thread.start()
+                elif self.__heap[0][2] is scheduled_event:
+                    self.__condition.notify()
+        return scheduled_event
     
-class _OneParamWeakRefObserverHolder(_WeakRefObserverHolder):
-    """
-    A concrete class of _WeakRefObserverHolder for a one parameter callable.
-    """
-
-    def __init__(self, observer, method):
-        super(_OneParamWeakRefObserverHolder, self).__init__(observer, method)
+    def cancel(self, scheduled_event):
+        with self.__condition:
+            if scheduled_event.cancelled or scheduled_event.sent:
+                return False
+            scheduled_event.cancelled = True
+            self.__cancelled += 1
+            # Rebuild the heap when most of it is cancelled, so the cost
+            # of a cancel stays constant on average:
+            if self.__cancelled * 2 > len(self.__heap):
+                self.__heap = [entry for entry in self.__heap \
+                               if not entry[2].cancelled]
+                heapq.heapify(self.__heap)
+                self.__cancelled = 0
+            return True
     
-    def __call__(self, event):
+    def run_pending(self):
+        count = 0
+        now = _monotonic()
+        scheduled_event = self.__pop_due(now)
+        while scheduled_event != None:
+            self.__registry.send_event(scheduled_event.event)
+            count += 1
+            scheduled_event = self.__pop_due(now)
+        return count
+    
+    def __pop_due(self, now):
+        """
+        Get the next event due at now and not cancelled or None.
+        """
+        
+        with self.__condition:
+            heap = self.__heap
+            while heap and heap[0][0] <= now:
+                scheduled_event = heapq.heappop(heap)[2]
+                if scheduled_event.cancelled:
+                    self.__cancelled -= 1
+                else:
+                    scheduled_event.sent = True
+                    return scheduled_event
+        return None
+    
+    def __run(self):
+        """
+        Send the events until no event is scheduled.
+        """
+        
+        while True:
+            with self.__condition:
+                heap = self.__heap
+                while heap and heap[0][0] > _monotonic():
+                    self.__condition.wait(heap[0][0] - _monotonic())
+                    heap = self.__heap
+                if not heap:
+                    self.__thread = None
+                    return
+            try:
+                self.run_pending()
+            except Exception:
+                logging.getLogger(__name__).exception("Error sending the " \
+                  "scheduled events.")
+
+#==============================================================================
+# _DeferredDispatch
+#==============================================================================
+
+class _DeferredDispatch(object):
+    """
+    The context manager returned by ObserverRegistry.deferred.
+    """
+    
+    def __init__(self, registry, key):
+        self.__registry = registry
+        self.__key = key
+        
+    def __enter__(self):
+        self.__registry._begin_deferred(self.__key)
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.__registry._end_deferred()
+
+#==============================================================================
+# CircuitBreaker
+#==============================================================================
+
+class CircuitBreaker(object):
+    """
+    Stop notifying an observer that fails or is too slow. The breaker opens
+    after max_failures consecutive failures; the observer is then skipped
+    until cooldown seconds have passed. The next call probes the observer:
+    a success closes the breaker, a failure opens it again. Give each
+    observer its own breaker with add_observer(breaker=...).
+    """
+    
+    CLOSED = "closed"
+    """
+    State: the observer is notified.
+    """
+    
+    OPEN = "open"
+    """
+    State: the observer is skipped.
+    """
+    
+    HALF_OPEN = "half open"
+    """
+    State: the observer is notified to probe it.
+    """
+    
+    def __init__(self, max_failures=5, latency_budget=None, cooldown=30.0):
+        """
+        Create a new CircuitBreaker.
+        @param max_failures: The number of consecutive failures opening the
+        breaker. Optional.
+        @param latency_budget: The number of seconds above which a call
+        counts as a failure. None means no limit. Optional.
+        @param cooldown: The number of seconds the breaker stays open.
+        Optional.
+        """
+        
+        assert max_failures > 0, "max_failures must be a positive integer."
+        self.max_failures = max_failures
+        self.latency_budget = latency_budget
+        self.cooldown = cooldown
+        self.failures = 0
+        """
+        The number of consecutive failures.
+        """
+        self.__state = CircuitBreaker.CLOSED
+        self.__opened_at = None
+        
+    @property
+    def state(self):
+        """
+        The state of the breaker: CLOSED, OPEN or HALF_OPEN.
+        """
+        
+        if self.__state == CircuitBreaker.OPEN:
+            now = _monotonic()
+            # The fallback clock may step backwards, the cooldown then
+            # restarts:
+            if now < self.__opened_at:
+                self.__opened_at = now
+            elif now - self.__opened_at >= self.cooldown:
+                self.__state = CircuitBreaker.HALF_OPEN
+        return self.__state
+    
+    def allows(self):
+        """
+        Tell if the observer can be called.
+        """
+        
+        return self.__state == CircuitBreaker.CLOSED or \
+          self.state != CircuitBreaker.OPEN
+    
+    def record(self, duration, failed):
+        """
+        Record the result of a call of the observer.
+        @param duration: The duration of the call in seconds.
+        @param failed: True if the call raised an exception.
+        """
+        
+        if failed or (self.latency_budget != None and \
+                      duration > self.latency_budget):
+            self.failures += 1
+            if self.__state == CircuitBreaker.HALF_OPEN or \
+              self.failures >= self.max_failures:
+                self.__state = CircuitBreaker.OPEN
+                self.__opened_at = _monotonic()
+        else:
+            self.failures = 0
+            self.__state = CircuitBreaker.CLOSED
+    
+    def __repr__(self):
+        return "CircuitBreaker(" + repr(self.state) + ", " + \
+          repr(self.failures) + ")"
+
+#==============================================================================
+# _Throttle
+#==============================================================================
+
+class _Throttle(object):
+    """
+    A token bucket limiting the rate of the events an observer receives.
+    """
+    
+    def __init__(self, count, period, policy, queue_capacity):
+        assert count > 0 and period > 0, "The rate must be positive."
+        assert policy in (ObserverRegistry.RATE_DROP, \
+                          ObserverRegistry.RATE_KEEP_LATEST, \
+                          ObserverRegistry.RATE_QUEUE), "Unknown rate policy."
+        self.capacity = count
+        self.tokens_per_second = float(count) / period
+        self.tokens = float(count)
+        self.last_time = _monotonic()
+        self.policy = policy
+        self.suppressed = 0
+        # The events suppressed to deliver later, oldest first:
+        self.pending = deque(maxlen=queue_capacity \
+          if policy == ObserverRegistry.RATE_QUEUE else 1)
+        
+    def acquire(self):
+        """
+        Take a token if one is available.
+        @return: True if a token was taken.
+        """
+        
+        now = _monotonic()
+        # The fallback clock may step backwards:
+        tokens = min(self.capacity, self.tokens + \
+                     max(0, now - self.last_time) * self.tokens_per_second)
+        self.last_time = now
+        if tokens >= 1:
+            self.tokens = tokens - 1
+            return True
+        self.tokens = tokens
+        return False
+    
+    def suppress(self, event):
+        """
+        Count a suppressed event and keep it if the policy asks for it.
+        """
+        
+        self.suppressed += 1
+        if self.policy != ObserverRegistry.RATE_DROP:
+            # The oldest event is dropped when full:
+            self.pending.append(event)
+
+#==============================================================================
+# _Sampler
+#==============================================================================
+
+class _Sampler(object):
+    """
+    Decide which events an observer registered with sample receives.
+    """
+    
+    def __init__(self, sample, seed, by_sender):
+        if isinstance(sample, (int, long)):
+            assert sample > 0, "The sample must be a positive integer."
+            self.every = sample
+            self.probability = None
+        else:
+            assert 0 < sample <= 1, "The sample must be a probability."
+            self.every = None
+            self.probability = sample
+        self.seed = seed
+        self.by_sender = by_sender
+        self.__count = 0
+        self.__random = random.Random(seed).random
+        
+    def accepts(self, event):
+        """
+        Tell if an event must be delivered.
+        """
+        
+        return self.__accepts(event.sender)
+    
+    def select(self, batch):
+        """
+        Get the EventBatch of the events of a batch that must be delivered.
+        @return: The EventBatch or None if no event must be delivered.
+        """
+        
+        indices = [index for index, sender in enumerate(batch.senders) \
+                   if self.__accepts(sender)]
+        if len(indices) == len(batch):
+            return batch
+        return batch.select(indices) if indices else None
+    
+    def __accepts(self, sender):
+        if self.by_sender:
+            # The same senders are always included:
+            key = _mix32(hash(sender) ^ hash(self.seed))
+            if self.every != None:
+                return key % self.every == 0
+            return key < self.probability * 0x100000000
+        if self.every != None:
+            accepted = self.__count == 0
+            self.__count = (self.__count + 1) % self.every
+            return accepted
+        return self.__random() < self.probability
+
+#==============================================================================
+# _StickyEventCache
+#==============================================================================
+
+class _StickyEventCache(object):
+    """
+    A bounded cache of the last event sent for each sticky (sender, name) key.
+    The events are indexed by sender and by name like the registrations in the
+    delegates so replaying never scans the whole cache.
+    """
+    
+    def __init__(self, capacity):
+        assert capacity > 0, "The capacity must be positive."
+        self.capacity = capacity
+        # Names sticky for every sender:
+        self.__names = set()
+        # Sticky (sender, name) keys:
+        self.__keys = set()
+        # The events by (sender, name), least recently used first:
+        self.__events = OrderedDict()
+        self.__keys_by_sender = dict()
+        self.__keys_by_name = dict()
+        
+    def __len__(self):
+        return len(self.__events)
+        
+    def is_sticky(self, sender, name):
+        """
+        Tell if the events with sender and name must be retained.
+        """
+        
+        if not self.__names and not self.__keys:
+            return False
+        return name in self.__names or (sender, name) in self.__keys
+    
+    def is_sticky_for_sender(self, sender, name):
+        """
+        Tell if the events with sender and name are retained because of a
+        key of the sender.
+        """
+        
+        return bool(self.__keys) and (sender, name) in self.__keys
+    
+    def sender_keys(self):
+        """
+        Get the set of the sticky (sender, name) keys. The set is modified in
+        place.
+        """
+        
+        return self.__keys
+        
+    def add_sticky(self, sent_by, named):
+        if sent_by == None:
+            self.__names.add(named)
+        else:
+            self.__keys.add((sent_by, named))
+            
+    def remove_sticky(self, sent_by, named):
+        if sent_by == None:
+            self.__names.discard(named)
+            keys = list(self.__keys_by_name.get(named, ()))
+        else:
+            self.__keys.discard((sent_by, named))
+            keys = [(sent_by, named)]
+        for key in keys:
+            if key in self.__events and not self.is_sticky(*key):
+                self.__discard(key)
+        
+    def put(self, event):
+        key = (event.sender, event.name)
+        if self.__events.pop(key, None) == None:
+            self.__keys_by_sender.setdefault(event.sender, set()).add(key)
+            self.__keys_by_name.setdefault(event.name, set()).add(key)
+            if len(self.__events) >= self.capacity:
+                self.__discard(next(iter(self.__events)))
+        self.__events[key] = event
+        
+    def get(self, sent_by, named):
+        """
+        Get the events retained matching a registration. The events returned
+        are marked as used.
+        """
+        
+        if sent_by == None and named == None:
+            keys = list(self.__events)
+        elif named == None:
+            keys = self.__keys_by_sender.get(sent_by, ())
+        elif sent_by == None:
+            keys = self.__keys_by_name.get(named, ())
+        else:
+            keys = [(sent_by, named)] if (sent_by, named) in self.__events \
+              else ()
+        events = [(self.__events.pop(key), key) for key in keys]
+        for event, key in events:
+            self.__events[key] = event
+        return [event for event, key in events]
+    
+    def __discard(self, key):
+        del self.__events[key]
+        sender, name = key
+        for index, index_key in ((self.__keys_by_sender, sender), \
+                                 (self.__keys_by_name, name)):
+            keys = index[index_key]
+            keys.discard(key)
+            if not keys:
+                del index[index_key]
+
+# Create the default registry:
+ObserverRegistry.default_registry = ObserverRegistry()
+
+#==============================================================================
+# _ObserverHolder
+#==============================================================================
+
+class _ObserverHolder(object):
+    """
+    An abstract class encapsulating of observer so they all can be treated
+    polymorphically.
+    """
+    
+    remaining_calls = None
+    """
+    The number of calls left before the observer is retired. None means no
+    limit.
+    """
+    
+    registration = None
+    """
+    The (registry, delegate, sent_by, named) used to retire an observer
+    registered with max_calls.
+    """
+    
+    batch = False
+    """
+    Tell if the observer receives the events sent with send_batch in a single
+    EventBatch.
+    """
+    
+    throttle = None
+    """
+    The _Throttle limiting the rate of the events received or None.
+    """
+    
+    sampler = None
+    """
+    The _Sampler choosing the events received or None.
+    """
+    
+    breaker = None
+    """
+    The CircuitBreaker of the observer or None.
+    """
+    
+    def __new__(cls, observer, method="__call__"):
+        """
+        The constructor of the class. Will create the appropriate instance
+        type based on observer.
+        """
+
+        if cls == _NullObserverHolder:
+            return object.__new__(cls, observer)
+        
+        for delegate_class in cls.__subclasses__():
+            if delegate_class == _NullObserverHolder:
+                continue
+            is_holder_or_class = delegate_class._is_holder_or_class(observer, \
+                                                                    method) 
+            if is_holder_or_class:
+                class_type = delegate_class if is_holder_or_class is True \
+                  else is_holder_or_class
+                return object.__new__(class_type, observer, method)
+        raise ValueError("Observer is not callable with 1 or 0 argument " + \
+                         "or an IObserver.")
+        
+    def __init__(self, method):
+        if self.__class__ == _ObserverHolder:
+            raise TypeError(self.__class__.__name__ + " is an abstract class" \
+              + " that cannot be instantiated.")
+        self._hash = hash(self.observer)
+        self.method = method
+    
+    def __call__(self, event):
+        """
+        Every observer holder must be able to call the observer they are
+        holding.
+        """
+
+        raise NotImplementedError()
+    
+    def __eq__(self, other):
+        if isinstance(other, _ObserverHolder):
+            if self.is_dead:
+                return other.is_dead
+            return self.observer == other.observer
+        return False
+    
+    def __ne__(self, other):
+        return not (self == other)
+    
+    def __hash__(self):
+        return self._hash
+    
+    @classmethod
+    def _is_holder_or_class(cls, observer, method):
+        """
+        Method derived class must implement to tell if they can hold this
+        type of observer. They may return True or false (truth as Python 
+        defines it) or the class to be used.
+        """
+
+        raise NotImplementedError()
+
+    @property
+    def is_dead(self):
+        """
+        Property telling if an observer is still alive. This method is used to
+        manage weak references that may be gone.
+        """
+
+        raise NotImplementedError()
+    
+    @property
+    def observer(self):
+        """
+        Property to get access the observer the holder is holding.
+        """
+
+        raise NotImplementedError()
+
+    @staticmethod
+    def _is_zero_param(info):
+        if info:
+            min_arg = 0
+            if not info["is_function"]:
+                min_arg = 1
+            return info["len_agr_spec"] == min_arg
+        return False
+    
+    @staticmethod
+    def _is_one_param(info):
+        if info:
+            min_arg = 1
+            if not info["is_function"]:
+                min_arg = 2
+            return (info["len_agr_spec"] >= min_arg \
+              and info["len_agr_spec"] - info["len_arg_spec_defaults"] \
+                <= min_arg) or info["varargs"]
+        return False
+
+    @staticmethod
+    def _callable_param_info(observer, method):
+        """
+        A method giving information about the parameters of a callable.
+        """
+
+        info = dict()
+        if not isinstance(observer, types.BuiltinFunctionType):
+            if not (isinstance(observer, types.FunctionType) \
+                    and method == "__call__"):
+                if hasattr(observer, method):
+                    observer = getattr(observer, method)
+                else:
+                    return info
+            if callable(observer):
+                info["is_function"] = isinstance(observer, types.FunctionType)
+                arg_spec = inspect.getargspec(observer)
+                info["len_agr_spec"] = len(arg_spec.args)
+                info["len_arg_spec_defaults"] = 0 if not arg_spec.defaults \
+                    else len(arg_spec.defaults)
+                info["varargs"] = bool(arg_spec.varargs)
+        return info
+    
+    @staticmethod
+    def _is_function(o):
+        return isinstance(o, (types.FunctionType, types.BuiltinFunctionType))
+    
+class _NullObserverHolder(_ObserverHolder):
+    """
+    An null observer just needed to remove observers.
+    """
+    def __init__(self, observer):
+        self.__observer = observer
+        super(_NullObserverHolder, self).__init__("")
+        
+    def __call__(self, event):
+        pass
+    
+    @property
+    def is_dead(self):
+        return False
+    
+    @property
+    def observer(self):
+        return self.__observer
+
+
+
+class _IObserverHolder(_ObserverHolder):
+    """
+    An abstract final holder for an IObserver to be scan by _ObserverHolder. 
+    Only direct subclasses of _ObserverHolder are scanned.
+    """
+
+    @classmethod
+    def _is_holder_or_class(cls, observer, method):
+        if _IObserverWeakRefInstanceObserverHolder \
+          ._is_holder_or_class(observer, "receive_event"):
+            return _IObserverWeakRefInstanceObserverHolder
+    
+    def __init__(self, observer):
+        raise TypeError(self.__class__.__name__ + " is an abstract final"
+          " class that cannot be instantiated.")
+
+class _WeakRefObserverHolder(_ObserverHolder):
+    """
+    An abstract holder using a weak reference.
+    """
+
+    @classmethod
+    def _is_holder_or_class(cls, observer, method):
+        info = cls._callable_param_info(observer, method)
+        if info:
+            try:
+                weakref.ref(observer)
+            except:
+                return False
+            if cls._is_zero_param(info):
+                return _ZeroParamWeakRefObserverHolder
+            elif cls._is_one_param(info):
+                return _OneParamWeakRefObserverHolder
+    
+    def __init__(self, observer, method):
+        if self.__class__ == _WeakRefObserverHolder:
+            raise TypeError(self.__class__.__name__ + " is an abstract class" \
+              + " that cannot be instantiated.")
+        self.weak_ref = weakref.ref(observer)
+        super(_WeakRefObserverHolder, self).__init__(method)
+    
+    def __call__(self, event):
+        raise NotImplementedError
+            
+    @property
+    def is_dead(self):
+        return self.weak_ref() == None
+
+    @property
+    def observer(self):
+        return self.weak_ref()
+    
+class _ZeroParamWeakRefObserverHolder(_WeakRefObserverHolder):
+    """
+    A concrete class of _WeakRefObserverHolder for a zero parameter callable.
+    """
+
+    def __init__(self, observer, method):
+        super(_ZeroParamWeakRefObserverHolder, self).__init__(observer, method)
+    
+    def __call__(self, event):
+        observer = self.observer
+        if observer != None:
+            return getattr(observer, self.method)()
+    
+class _OneParamWeakRefObserverHolder(_WeakRefObserverHolder):
+    """
+    A concrete class of _WeakRefObserverHolder for a one parameter callable.
+    """
+
+    def __init__(self, observer, method):
+        super(_OneParamWeakRefObserverHolder, self).__init__(observer, method)
+    
+    def __call__(self, event):
+        observer = self.observer
+        if observer != None:
+            return getattr(observer, self.method)(event)
+    
+class _DeclaredObserverHolder(_WeakRefObserverHolder):
+    """
+    A holder for an instance of an Observing class. The same holder is
+    registered under all the keys of the table of the class and calls the
+    methods declared for the event received.
+    """
+    
+    def __new__(cls, observer, table):
+        return object.__new__(cls)
+    
+    def __init__(self, observer, table):
+        self.table = table
+        super(_DeclaredObserverHolder, self).__init__(observer, "")
+    
+    def __call__(self, event):
         observer = self.observer
         if observer != None:
-            getattr(observer, self.method)(event)
+            result = None
+            for method, zero_param in self.table.matching(event.sender, \
+                                                          event.name):
+                if zero_param:
+                    result = getattr(observer, method)()
+                else:
+                    result = getattr(observer, method)(event)
+            return result
+    
+class _ObserverShardsKey(_WeakRefObserverHolder):
+    """
+    A holder only used as the key of the shards of an observer in a
+    ShardedObserverRegistry. The observer is held by a weak reference.
+    """
+    
+    def __new__(cls, observer):
+        return object.__new__(cls)
+    
+    def __init__(self, observer):
+        super(_ObserverShardsKey, self).__init__(observer, "")
+        
+    def __call__(self, event):
+        pass
     
 class _IObserverWeakRefInstanceObserverHolder \
   (_WeakRefObserverHolder):
@@ -547,7 +2833,7 @@ class _IObserverWeakRefInstanceObserverHolder \
     def __call__(self, event):
         observer = self.observer
         if observer != None:
-            observer.receive_event(event)
+            return observer.receive_event(event)
     
 
 class _HardRefObserverHolder(_ObserverHolder):
@@ -567,9 +2853,9 @@ class _HardRefObserverHolder(_ObserverHolder):
     
     def __call__(self, event):
         try:
-            getattr(self.observer, self.method)(event)
+            return getattr(self.observer, self.method)(event)
         except TypeError:
-            getattr(self.observer, self.method)()
+            return getattr(self.observer, self.method)()
             
     @property
     def is_dead(self):
@@ -598,24 +2884,202 @@ class IObserver(object):
         raise NotImplementedError()
     
 #==============================================================================
-# observer
+# observer
+#==============================================================================
+
+def observer(sent_by=None, named=None, registry=None, **options):
+    """
+    A decorator that automatically register the function decorated.
+    @param sent_by: The sender to observe.
+    @param named: The name of the event to observe.
+    @param registry: The registry to use. None means default_registry.
+    @param options: Other keyword arguments given to add_observer like
+    max_calls.
+    """
+    
+    _validate_event_name(named)
+    def decorator(func):
+        registry_imp = registry if registry \
+          else ObserverRegistry.default_registry 
+        registry_imp.add_observer(func, sent_by, named, **options)
+        return func
+    return decorator
+
+#==============================================================================
+# observes
+#==============================================================================
+
+def observes(sent_by=None, named=None):
+    """
+    A decorator declaring a method of an Observing class as an observer. The
+    instances of the class are registered when they are created. The
+    decorator may be stacked to observe several events with the same method.
+    @param sent_by: The sender to observe.
+    @param named: The name of the event to observe.
+    """
+    
+    _validate_event_name(named)
+    def decorator(func):
+        declarations = func.__dict__.setdefault("_observes", [])
+        declarations.insert(0, (sent_by, named))
+        return func
+    return decorator
+
+class _ObserverTable(object):
+    """
+    The subscriptions declared with observes by an Observing class. It is
+    computed once by class.
+    """
+    
+    def __init__(self, methods_by_key):
+        """
+        @param methods_by_key: A dictionary of (sent_by, named) to a list of
+        (method name, zero_param).
+        """
+        
+        self.__methods_by_key = methods_by_key
+        self.keys = tuple(methods_by_key)
+    
+    @classmethod
+    def for_class(cls, klass):
+        """
+        Build the table of a class from the methods decorated with observes.
+        A method overridden without the decorator is not an observer.
+        """
+        
+        methods_by_key = dict()
+        for name in sorted(dir(klass)):
+            func = getattr(getattr(klass, name, None), "im_func", None)
+            declarations = getattr(func, "_observes", None)
+            if not declarations:
+                continue
+            info = _ObserverHolder._callable_param_info(func, "__call__")
+            info["is_function"] = False # self is bound at call time
+            zero_param = _ObserverHolder._is_zero_param(info)
+            assert zero_param or _ObserverHolder._is_one_param(info), \
+              "Method " + name + " must take zero or one parameter."
+            for key in declarations:
+                methods_by_key.setdefault(key, []).append((name, zero_param))
+        return cls(methods_by_key)
+    
+    def restricted(self, keys):
+        """
+        Get a table with only some keys of this table.
+        """
+        
+        return _ObserverTable(dict((key, self.__methods_by_key[key]) \
+                                   for key in keys))
+    
+    def matching(self, sender, name):
+        """
+        Get the (method name, zero_param) to call for an event.
+        """
+        
+        methods = []
+        for key in ((None, None), (sender, None), (None, name), \
+                    (sender, name)):
+            methods.extend(self.__methods_by_key.get(key, ()))
+        return methods
+
+class _ObservingMeta(type):
+    """
+    The metaclass of Observing computing the table of the subscriptions
+    of a class and registering its instances.
+    """
+    
+    def __init__(cls, name, bases, attributes):
+        super(_ObservingMeta, cls).__init__(name, bases, attributes)
+        cls._observer_table = _ObserverTable.for_class(cls)
+    
+    def __call__(cls, *args, **kwargs):
+        instance = super(_ObservingMeta, cls).__call__(*args, **kwargs)
+        if cls._observer_table.keys:
+            registry = cls.observer_registry if cls.observer_registry \
+              else ObserverRegistry.default_registry
+            registry._add_declared_observer(instance, cls._observer_table)
+        return instance
+
+class Observing(object):
+    """
+    A base class for classes with methods decorated with observes. Each
+    instance is registered with a weak reference in a single operation once
+    created. Registering an instance with add_observer replaces its declared
+    subscriptions.
+    """
+    
+    __metaclass__ = _ObservingMeta
+    
+    observer_registry = None
+    """
+    The registry of the instances. None means default_registry.
+    """
+
+#==============================================================================
+# EventType
 #==============================================================================
 
-def observer(sent_by=None, named=None, registry=None):
+class EventType(str):
     """
-    A decorator that automatically register the function decorated.
-    @param sent_by: The sender to observe.
-    @param named: The name of the event to observe.
-    @param registry: The registry to use. None means default_registry.
+    An event name declared up front. A declared name has a small integer id
+    and its events skip the validation of the name. An EventType is equal to
+    the string of its name, so the string names remain usable::
+    
+        SAVED, CLOSED = EventType.declare("saved", "closed")
+        registry.send_event(document, SAVED)
+    
+    Creating an EventType with a name already declared returns the same
+    EventType.
     """
     
-    _validate_event_name(named)
-    def decorator(func):
-        registry_imp = registry if registry \
-          else ObserverRegistry.default_registry 
-        registry_imp.add_observer(func, sent_by, named)
-        return func
-    return decorator
+    __types = []
+    __types_by_name = dict()
+    __lock = threading.Lock()
+    
+    def __new__(cls, name):
+        event_type = cls.__types_by_name.get(name)
+        if event_type != None:
+            return event_type
+        assert isinstance(name, basestring) and name != "", \
+          "Event names must be none empty strings."
+        with cls.__lock:
+            event_type = cls.__types_by_name.get(name)
+            if event_type == None:
+                event_type = str.__new__(cls, name)
+                event_type.id = len(cls.__types)
+                cls.__types.append(event_type)
+                cls.__types_by_name[str(name)] = event_type
+        return event_type
+    
+    @classmethod
+    def declare(cls, *names):
+        """
+        Declare event types.
+        @param names: The names of the event types.
+        @return: A tuple of the EventType in the order of names.
+        """
+        
+        return tuple(cls(name) for name in names)
+    
+    @classmethod
+    def get(cls, name_or_id):
+        """
+        Get a declared event type.
+        @param name_or_id: The name or the id of the event type.
+        @return: The EventType or None if it is not declared.
+        """
+        
+        if isinstance(name_or_id, basestring):
+            return cls.__types_by_name.get(name_or_id)
+        if 0 <= name_or_id < len(cls.__types):
+            return cls.__types[name_or_id]
+        return None
+    
+    def __reduce__(self):
+        # Ids are local to a process, the type is declared again by name:
+        return EventType, (str(self),)
+    
+    def __repr__(self):
+        return "EventType(" + str.__repr__(self) + ")"
 
 #==============================================================================
 # Event
@@ -625,30 +3089,74 @@ class Event(object):
     '''
     Encapsulate the information about an event. An event has as a sender
     (an object), a name (a string) and an info attribute that is usually a
-    dictionary.
+    dictionary. The info can be computed on first access by a factory.
     '''
     
     @staticmethod
     def _validate_sender_name(sender, name):
         assert sender != None and sender != "", "Sender must be specified."
-        assert name != None and name != "", "Name must be specified."
-        assert isinstance(name, basestring), "Name must be a string."
+        if name.__class__ is not EventType:
+            assert name != None and name != "", "Name must be specified."
+            assert isinstance(name, basestring), "Name must be a string."
         
     
-    def __init__(self, sender, name, info=None):
+    def __init__(self, sender, name, info=None, info_factory=None):
         """
         Create a new Event object.
         @param sender: The sender of the event. Cannot be None.
         @param name: The name of the event. Must be a none empty string.
         @param info: An optional object containing more information about the
         event. Recommendation: Use a dictionary.
+        @param info_factory: A function without argument returning the info.
+        It is called at most once, the first time info is accessed. Cannot be
+        used with info. Optional.
         """
         
         assert self.__class__ == Event, "Event is final."
         Event._validate_sender_name(sender, name)
+        assert info == None or info_factory == None, "The info and the " + \
+          "info factory are exclusive."
         self.sender = sender
         self.name = name
-        self.info = info
+        self.__info = info
+        self.__info_factory = info_factory
+        # Makes sure the info factory is called once. Each event has its own
+        # lock so a factory may read the info of other events:
+        self.__info_lock = threading.Lock() if info_factory != None \
+          else None
+        
+    @property
+    def info(self):
+        """
+        The info of the event. Computed by the info factory on first access.
+        """
+        
+        if self.__info_factory != None:
+            with self.__info_lock:
+                # Another thread may have computed it:
+                if self.__info_factory != None:
+                    self.__info = self.__info_factory()
+                    self.__info_factory = None
+        return self.__info
+    
+    @info.setter
+    def info(self, info):
+        self.__info = info
+        self.__info_factory = None
+        
+    @property
+    def has_info(self):
+        """
+        Tell if the info is known without calling the info factory.
+        """
+        
+        return self.__info_factory == None
+    
+    def __getstate__(self):
+        return (self.sender, self.name, self.info)
+    
+    def __setstate__(self, state):
+        self.sender, self.name, self.info = state
 
     def __eq__(self, other): 
         if isinstance(other, Event):
@@ -667,10 +3175,738 @@ class Event(object):
         return "%s(%s, %s, %s)" % (self.__class__.__name__, repr(self.sender),\
                                    repr(self.name), repr(self.info), )
     
+class _EventKey(object):
+    """
+    The sender and the name of events, used in place of an Event to find
+    their observers without creating it.
+    """
+    
+    def __init__(self, sender, name):
+        self.sender = sender
+        self.name = name
+    
+#==============================================================================
+# EventBatch
+#==============================================================================
+
+class EventBatch(object):
+    '''
+    Many events having the same name. The info of the events are stored by
+    columns: a dictionary mapping each field to a sequence holding the value of
+    the field for each event, like a list or a NumPy array. The Event objects
+    are only created when accessed.
+    '''
+    
+    def __init__(self, senders, name, info=None):
+        """
+        Create a new EventBatch.
+        @param senders: The sequence of the sender of each event.
+        @param name: The name of the events. Must be a none empty string.
+        @param info: A dictionary mapping field names to sequences of the same
+        length as senders. The info of each event is a dictionary of the
+        values of the fields for the event. None means the events have no
+        info. Optional.
+        """
+        
+        for sender in senders:
+            Event._validate_sender_name(sender, name)
+        assert info == None or all(len(column) == len(senders) for column \
+                                   in info.itervalues()), "The columns " + \
+                                   "must have one value by event."
+        self.senders = senders
+        self.name = name
+        self.info = info
+        self.__events = [None] * len(senders)
+        
+    def __len__(self):
+        return len(self.senders)
+    
+    def __getitem__(self, index):
+        """
+        Get the Event at an index. The events are created once.
+        """
+        
+        event = self.__events[index]
+        if event == None:
+            info = None if self.info == None else dict((field, column[index]) \
+              for field, column in self.info.iteritems())
+            event = Event(self.senders[index], self.name, info)
+            self.__events[index] = event
+        return event
+    
+    def __iter__(self):
+        for index in xrange(len(self)):
+            yield self[index]
+            
+    def select(self, indices):
+        """
+        Get an EventBatch of some of the events. The columns having a take
+        method, like NumPy arrays, are selected with it.
+        @param indices: The indices of the events.
+        """
+        
+        if self.info == None:
+            return EventBatch._from_events(self.name, [self[index] for index \
+                                                       in indices])
+        info = dict((field, _take(column, indices)) for field, column \
+                    in self.info.iteritems())
+        return EventBatch(_take(self.senders, indices), self.name, info)
+    
+    @classmethod
+    def _from_events(cls, name, events):
+        """
+        Create a batch of existing events. The events keep their own info and
+        the info of the batch is None.
+        @param name: The name of the events.
+        @param events: The Event objects.
+        """
+        
+        batch = cls([event.sender for event in events], name)
+        batch.__events = list(events)
+        return batch
+    
+    def __repr__(self):
+        return "%s(%s, %s, %s)" % (self.__class__.__name__, \
+                                   repr(self.senders), repr(self.name), \
+                                   repr(self.info), )
+
+#==============================================================================
+# EventStream
+#==============================================================================
+
+class EventStream(object):
+    """
+    An iterator over the events sent to a registry, created by
+    ObserverRegistry.stream. The events are kept in a bounded buffer until
+    taken. Leaving the with block or calling close removes the stream from
+    the registry; the iteration then stops once the buffer is empty.
+    """
+    
+    DROP_OLDEST = "drop oldest"
+    """
+    Overflow policy: the oldest event of a full buffer is dropped.
+    """
+    
+    DROP_NEWEST = "drop newest"
+    """
+    Overflow policy: the event sent to a full buffer is dropped.
+    """
+    
+    BLOCK = "block"
+    """
+    Overflow policy: the sender waits until the buffer has room. The events
+    must be taken by another thread.
+    """
+    
+    def __init__(self, registry, sent_by=None, named=None, capacity=1024, \
+                 overflow=DROP_OLDEST):
+        """
+        Create a new stream and add it to a registry. See
+        ObserverRegistry.stream.
+        """
+        
+        assert capacity > 0, "The capacity must be positive."
+        assert overflow in (EventStream.DROP_OLDEST, EventStream.DROP_NEWEST, \
+                            EventStream.BLOCK), "Unknown overflow policy."
+        self.registry = registry
+        self.capacity = capacity
+        self.overflow = overflow
+        # The number of events dropped because the buffer was full:
+        self.dropped = 0
+        self.__events = deque()
+        self.__condition = threading.Condition()
+        self.__closed = False
+        registry.add_observer(self, sent_by, named)
+        
+    def __call__(self, event):
+        with self.__condition:
+            if self.__closed:
+                return
+            if len(self.__events) >= self.capacity:
+                if self.overflow == EventStream.BLOCK:
+                    while len(self.__events) >= self.capacity and \
+                      not self.__closed:
+                        self.__condition.wait()
+                    if self.__closed:
+                        return
+                else:
+                    self.dropped += 1
+                    if self.overflow == EventStream.DROP_NEWEST:
+                        return
+                    self.__events.popleft()
+            self.__events.append(event)
+            self.__condition.notify_all()
+            
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        
+    def __iter__(self):
+        return self
+    
+    def next(self):
+        """
+        Get the next event, waiting until one is sent.
+        @raise StopIteration: The stream is closed and its buffer is empty.
+        """
+        
+        with self.__condition:
+            while not self.__events:
+                if self.__closed:
+                    raise StopIteration()
+                self.__condition.wait()
+            event = self.__events.popleft()
+            self.__condition.notify_all()
+            return event
+        
+    def take(self, max_count, timeout=None):
+        """
+        Take up to max_count events, waiting until there are max_count
+        events, the timeout expires or the stream is closed.
+        @param max_count: The maximum number of events to take.
+        @param timeout: The maximum number of seconds to wait. None means no
+        limit. Optional.
+        @return: A list of the events taken, possibly empty.
+        """
+        
+        deadline = None if timeout == None else time.time() + timeout
+        with self.__condition:
+            while len(self.__events) < max_count and not self.__closed:
+                remaining = None if deadline == None else \
+                  deadline - time.time()
+                if remaining != None and remaining <= 0:
+                    break
+                self.__condition.wait(remaining)
+            count = min(max_count, len(self.__events))
+            events = [self.__events.popleft() for i in xrange(count)]
+            self.__condition.notify_all()
+            return events
+        
+    def close(self):
+        """
+        Remove the stream from its registry. The events in the buffer can
+        still be taken.
+        """
+        
+        with self.__condition:
+            if self.__closed:
+                return
+            self.__closed = True
+            self.__condition.notify_all()
+        self.registry.remove_observer(self)
+
+#==============================================================================
+# EventBridge
+#==============================================================================
+
+class RemoteSender(object):
+    """
+    The sender of an event received from another process by an EventBridge.
+    Events having a RemoteSender as sender are never forwarded again.
+    """
+    
+    def __init__(self, origin, sender_id):
+        """
+        Create a new RemoteSender.
+        @param origin: The identifier of the EventBridge that forwarded the
+        event.
+        @param sender_id: The identifier of the sender in its process.
+        """
+        
+        self.origin = origin
+        self.sender_id = sender_id
+        
+    def __eq__(self, other):
+        if isinstance(other, RemoteSender):
+            return self.origin == other.origin and \
+              self.sender_id == other.sender_id
+        return False
+    
+    def __ne__(self, other):
+        return not (self == other)
+    
+    def __hash__(self):
+        return hash((self.origin, self.sender_id))
+    
+    def __repr__(self):
+        return "%s(%s, %s)" % (self.__class__.__name__, repr(self.origin), \
+                               repr(self.sender_id))
+
+class EventBroker(object):
+    """
+    A local broker listening on a Unix domain socket. Every frame received from
+    an EventBridge is sent to all the other bridges connected. The frames are
+    forwarded without being decoded.
+    """
+    
+    def __init__(self, path):
+        """
+        Create a new broker and start its thread.
+        @param path: The path of the Unix domain socket to create.
+        """
+        
+        self.path = path
+        self.__server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.__server.bind(path)
+        self.__server.listen(16)
+        self.__wake_up_read, self.__wake_up_write = os.pipe()
+        self.__thread = threading.Thread(target=self.__run)
+        self.__thread.daemon = True
+        self.__thread.start()
+        
+    def close(self):
+        """
+        Stop the broker, close all its connections and remove its socket.
+        """
+        
+        if self.__thread:
+            os.write(self.__wake_up_write, "x")
+            self.__thread.join()
+            self.__thread = None
+            os.close(self.__wake_up_read)
+            os.close(self.__wake_up_write)
+            os.remove(self.path)
+        
+    def __run(self):
+        # The data received by connection not making a complete frame yet:
+        buffers = dict()
+        try:
+            while True:
+                readable = select.select([self.__server, \
+                                          self.__wake_up_read] + \
+                                         buffers.keys(), [], [])[0]
+                for connection in readable:
+                    if connection == self.__wake_up_read:
+                        return
+                    if connection == self.__server:
+                        buffers[self.__server.accept()[0]] = ""
+                        continue
+                    data = connection.recv(65536)
+                    if not data:
+                        del buffers[connection]
+                        connection.close()
+                        continue
+                    data = buffers[connection] + data
+                    end = _complete_frames_end(data)
+                    buffers[connection] = data[end:]
+                    if end:
+                        self.__forward(data[:end], connection, buffers)
+        finally:
+            for connection in buffers:
+                connection.close()
+            self.__server.close()
+            
+    @staticmethod
+    def __forward(frames, source, buffers):
+        for connection in buffers.keys():
+            if connection != source:
+                try:
+                    connection.sendall(frames)
+                except socket.error:
+                    del buffers[connection]
+                    connection.close()
+
+class EventBridge(object):
+    """
+    Forward the events of selected names sent to a local registry to the
+    registries of other processes through an EventBroker. The events received
+    from the other processes are sent to the local registry with a
+    RemoteSender as sender.
+    
+    The events are sent in batches by a writer thread and the events received
+    are sent to the registry by a reader thread. The registry must support
+    being used from these threads.
+    
+    Each frame is a 4 bytes length in network order followed by a pickle of
+    the identifier of the bridge and of a list of (sender_id, name, info).
+    """
+    
+    def __init__(self, registry, path, names, batch_size=64, sender_id=None):
+        """
+        Create a new bridge connected to a broker.
+        @param registry: The local registry.
+        @param path: The path of the Unix domain socket of the broker.
+        @param names: The names of the events to forward.
+        @param batch_size: The maximum number of events written at once.
+        Optional.
+        @param sender_id: A function giving a serializable identifier of the
+        senders. The default keeps strings and integers and identifies other
+        senders by their class and id. Optional.
+        """
+        
+        assert batch_size > 0, "The batch size must be positive."
+        self.registry = registry
+        self.origin = uuid.uuid4().hex
+        self.batch_size = batch_size
+        self.__sender_id = sender_id if sender_id else _default_sender_id
+        self.__socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.__socket.connect(path)
+        self.__queue = Queue.Queue()
+        self.__threads = [threading.Thread(target=self.__write), \
+                          threading.Thread(target=self.__read)]
+        for thread in self.__threads:
+            thread.daemon = True
+            thread.start()
+        
+        # An observer by name since an observer has a single registration:
+        self.__forwarders = []
+        for name in names:
+            forwarder = _BridgeForwarder(self.__queue)
+            registry.add_observer(forwarder, named=name)
+            self.__forwarders.append(forwarder)
+            
+    def flush(self):
+        """
+        Wait until all the events forwarded are written to the broker.
+        """
+        
+        self.__queue.join()
+        
+    def close(self):
+        """
+        Stop forwarding events and close the connection to the broker after
+        the events forwarded are written.
+        """
+        
+        for forwarder in self.__forwarders:
+            self.registry.remove_observer(forwarder)
+        del self.__forwarders[:]
+        if self.__threads:
+            self.__queue.put(None)
+            self.__threads[0].join()
+            self.__socket.shutdown(socket.SHUT_RDWR)
+            self.__threads[1].join()
+            self.__socket.close()
+            self.__threads = None
+    
+    def __write(self):
+        queue = self.__queue
+        while True:
+            events = [queue.get()]
+            while events[-1] != None and len(events) < self.batch_size:
+                try:
+                    events.append(queue.get_nowait())
+                except Queue.Empty:
+                    break
+            try:
+                batch = [(self.__sender_id(event.sender), event.name, \
+                          event.info) for event in events if event != None]
+                if batch:
+                    self.__socket.sendall(self.__frames(batch))
+            except Exception:
+                logging.getLogger(__name__).exception("Error forwarding " \
+                  "events to the broker.")
+            finally:
+                for event in events:
+                    queue.task_done()
+            if events[-1] == None:
+                return
+                
+    def __frames(self, batch):
+        """
+        Get the frames of a batch of (sender id, name, info). The batch is
+        sent in a single frame unless an event cannot be pickled; each event
+        then has its own frame and the events that cannot be pickled are
+        dropped.
+        """
+        
+        try:
+            frames = [cPickle.dumps((self.origin, batch), \
+                                    cPickle.HIGHEST_PROTOCOL)]
+        except Exception:
+            frames = []
+            for item in batch:
+                try:
+                    frames.append(cPickle.dumps((self.origin, [item]), \
+                                                cPickle.HIGHEST_PROTOCOL))
+                except Exception:
+                    logging.getLogger(__name__).exception("Error pickling " \
+                      "the event %r.", item[1])
+        return "".join(struct.pack("!I", len(data)) + data for data in frames)
+    
+    def __read(self):
+        data = ""
+        while True:
+            try:
+                received = self.__socket.recv(65536)
+            except socket.error:
+                return
+            if not received:
+                return
+            data += received
+            end = _complete_frames_end(data)
+            frames, data = data[:end], data[end:]
+            index = 0
+            while index < end:
+                length = struct.unpack_from("!I", frames, index)[0]
+                index += 4
+                try:
+                    origin, batch = cPickle.loads(frames[index:index + length])
+                except Exception:
+                    logging.getLogger(__name__).exception("Error unpickling " \
+                      "events received from the broker.")
+                    batch = ()
+                index += length
+                for sender_id, name, info in batch:
+                    try:
+                        self.registry.send_event(RemoteSender(origin, \
+                                                              sender_id), \
+                                                 name, info)
+                    except Exception:
+                        logging.getLogger(__name__).exception("Error " \
+                          "notifying the observers of %r.", name)
+            
+class _BridgeForwarder(object):
+    """
+    The observer of an EventBridge for a name.
+    """
+    
+    def __init__(self, queue):
+        self.__queue = queue
+        
+    def __call__(self, event):
+        # Never forward back the events received from other processes:
+        if not isinstance(event.sender, RemoteSender):
+            self.__queue.put(event)
+    
+#==============================================================================
+# EventCodec
+#==============================================================================
+
+class EventCodec(object):
+    """
+    Encode events in a compact binary form to send them out of the process.
+    
+    The senders and the names registered are encoded by their integer
+    identifier. The others are encoded inline. The info is pickled except for
+    the bytes-like values (str, bytearray, buffer and memoryview) of at least
+    out_of_band_threshold bytes found in it: they are returned as separate
+    buffers referencing their memory so they are never copied. These values
+    are decoded as memoryview of the buffers given to decode.
+    
+    The codecs of two processes exchanging events must have the same
+    registrations.
+    """
+    
+    __HEADER = struct.Struct("!BII")
+    __SENDER_INLINE = 1
+    __NAME_INLINE = 2
+    __NAME_UNICODE = 4
+    
+    def __init__(self, out_of_band_threshold=4096):
+        """
+        Create a new codec.
+        @param out_of_band_threshold: The minimal size in bytes of the info
+        values encoded as separate buffers. Optional.
+        """
+        
+        self.out_of_band_threshold = out_of_band_threshold
+        self.__sender_ids = dict()
+        self.__senders = dict()
+        self.__name_ids = dict()
+        self.__names = dict()
+        
+    def register_sender(self, sender, sender_id):
+        """
+        Encode a sender by an identifier.
+        @param sender: The sender of the events.
+        @param sender_id: An integer identifying the sender in every process.
+        """
+        
+        assert 0 <= sender_id < 2 ** 32, "The identifier must fit 32 bits."
+        self.__sender_ids[sender] = sender_id
+        self.__senders[sender_id] = sender
+        
+    def register_name(self, name, name_id):
+        """
+        Encode an event name by an identifier.
+        @param name: The name of the events.
+        @param name_id: An integer identifying the name in every process.
+        """
+        
+        _validate_event_name(name)
+        assert 0 <= name_id < 2 ** 32, "The identifier must fit 32 bits."
+        self.__name_ids[name] = name_id
+        self.__names[name_id] = name
+        
+    def encode(self, event):
+        """
+        Encode an event.
+        @param event: The Event to encode.
+        @return: A list of buffers. The first is a str, the others are the
+        memoryview of the info values sent out of band.
+        """
+        
+        flags = 0
+        inline = []
+        sender_id = self.__sender_ids.get(event.sender)
+        if sender_id == None:
+            flags |= EventCodec.__SENDER_INLINE
+            inline.append(cPickle.dumps(event.sender, \
+                                        cPickle.HIGHEST_PROTOCOL))
+            sender_id = len(inline[-1])
+        name_id = self.__name_ids.get(event.name)
+        if name_id == None:
+            flags |= EventCodec.__NAME_INLINE
+            name = event.name
+            if isinstance(name, unicode):
+                flags |= EventCodec.__NAME_UNICODE
+                name = name.encode("utf-8")
+            inline.append(name)
+            name_id = len(name)
+        
+        buffers = [None]
+        info = cStringIO.StringIO()
+        pickler = cPickle.Pickler(info, cPickle.HIGHEST_PROTOCOL)
+        pickler.persistent_id = lambda value: \
+          self.__out_of_band_id(value, buffers)
+        pickler.dump(event.info)
+        buffers[0] = EventCodec.__HEADER.pack(flags, sender_id, name_id) + \
+          "".join(inline) + info.getvalue()
+        return buffers
+    
+    def decode(self, buffers):
+        """
+        Decode an event encoded by encode.
+        @param buffers: The buffers returned by encode or buffers having the
+        same content. The senders not registered by this codec are decoded as
+        their identifier.
+        @return: The decoded Event.
+        """
+        
+        head = buffers[0]
+        flags, sender_id, name_id = EventCodec.__HEADER.unpack_from(head)
+        index = EventCodec.__HEADER.size
+        if flags & EventCodec.__SENDER_INLINE:
+            sender = cPickle.loads(str(head[index:index + sender_id]))
+            index += sender_id
+        else:
+            sender = self.__senders.get(sender_id, sender_id)
+        if flags & EventCodec.__NAME_INLINE:
+            name = str(head[index:index + name_id])
+            if flags & EventCodec.__NAME_UNICODE:
+                name = name.decode("utf-8")
+            index += name_id
+        else:
+            name = self.__names[name_id]
+        
+        unpickler = cPickle.Unpickler(cStringIO.StringIO(head[index:]))
+        unpickler.persistent_load = lambda buffer_index: \
+          memoryview(buffers[buffer_index])
+        return Event(sender, name, unpickler.load())
+    
+    def dumps(self, event):
+        """
+        Encode an event in a single string. Unlike encode, the out of band
+        values are copied.
+        """
+        
+        buffers = self.encode(event)
+        return struct.pack("!I", len(buffers)) + "".join( \
+          struct.pack("!I", len(buffer)) + buffer.tobytes() \
+          if isinstance(buffer, memoryview) else \
+          struct.pack("!I", len(buffer)) + buffer for buffer in buffers)
+        
+    def loads(self, data):
+        """
+        Decode an event encoded by dumps. The out of band values are
+        memoryview of data.
+        """
+        
+        view = memoryview(data)
+        count = struct.unpack_from("!I", data)[0]
+        index = 4
+        buffers = []
+        for i in range(count):
+            length = struct.unpack_from("!I", data, index)[0]
+            index += 4
+            buffers.append(view[index:index + length])
+            index += length
+        buffers[0] = buffers[0].tobytes()
+        return self.decode(buffers)
+    
+    def __out_of_band_id(self, value, buffers):
+        if isinstance(value, (str, bytearray, buffer, memoryview)):
+            view = memoryview(value)
+            if view.itemsize * len(view) >= self.out_of_band_threshold:
+                buffers.append(view)
+                return len(buffers) - 1
+        return None
+    
 #==============================================================================
 # Private utility functions
 #==============================================================================
 
+_monotonic = getattr(time, "monotonic", time.time)
+"""
+The clock used to measure durations. time.monotonic when available.
+"""
+
+_NOT_CALLED = object()
+"""
+Returned by ObserverRegistry._notify when an observer was not called.
+"""
+
+def _object_size(o):
+    """
+    The size of an object and of its attribute dictionary.
+    """
+    
+    size = sys.getsizeof(o)
+    attributes = getattr(o, "__dict__", None)
+    if isinstance(attributes, dict):
+        size += sys.getsizeof(attributes)
+    return size
+
+def _mix32(value):
+    """
+    Spread the bits of a hash value over 32 bits (the finalizer of
+    MurmurHash3).
+    """
+    
+    value &= 0xffffffff
+    value ^= value >> 16
+    value = (value * 0x85ebca6b) & 0xffffffff
+    value ^= value >> 13
+    value = (value * 0xc2b2ae35) & 0xffffffff
+    return value ^ (value >> 16)
+
+def _take(sequence, indices):
+    """
+    Get the values of a sequence at some indices.
+    """
+    
+    if hasattr(sequence, "take"):
+        return sequence.take(indices)
+    return [sequence[index] for index in indices]
+
+def _default_sender_id(sender):
+    """
+    The default serializable identifier of a sender used by EventBridge.
+    """
+    
+    if isinstance(sender, (basestring, int, long)):
+        return sender
+    return "%s.%s@%x" % (sender.__class__.__module__, \
+                         sender.__class__.__name__, id(sender))
+
+def _complete_frames_end(data):
+    """
+    Get the end of the last complete length prefixed frame at the beginning
+    of data.
+    """
+    
+    end = 0
+    while len(data) - end >= 4:
+        frame_end = end + 4 + struct.unpack_from("!I", data, end)[0]
+        if frame_end > len(data):
+            break
+        end = frame_end
+    return end
+
 def _validate_event_name(name):
-    assert name == None or (isinstance(name, basestring) and name != ""), \
+    assert name.__class__ is EventType or name == None or \
+      (isinstance(name, basestring) and name != ""), \
         "Event names must be none empty strings."
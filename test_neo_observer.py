@@ -4,7 +4,14 @@ Created on 2010-08-11
 @author: Pierre Thibault
 '''
 from __future__ import with_statement
-from neo_observer import observer, IObserver, ObserverRegistry, Event
+from neo_observer import observer, IObserver, ObserverRegistry, Event, \
+  ShardedObserverRegistry, EventBroker, EventBridge, RemoteSender, \
+  EventCodec, EventBatch, EventStream, Observing, observes, \
+  EventType, EventCascadeError, EventDispatchError, CircuitBreaker
+import os
+import shutil
+import tempfile
+import threading
 import unittest
 
 class Prototype():
@@ -51,6 +58,20 @@ class Observer6(object):
     def receive_event_method(self, event):
         event_expected6.event = event
     
+def _fail():
+    raise ValueError("Cannot be unpickled.")
+
+class FailsToLoad(object):
+    def __reduce__(self):
+        return _fail, ()
+
+class Recorder(object):
+    def __init__(self):
+        self.events = []
+        
+    def __call__(self, event):
+        self.events.append(event)
+    
 class Test(unittest.TestCase):
 
     def setUp(self):
@@ -400,6 +421,1207 @@ class Test(unittest.TestCase):
         default_registry.send_event(e)
         
         
+    def test_max_calls(self):
+        calls = []
+        def one_shot(event):
+            calls.append(event)
+            # A nested send must not reach the retired observer:
+            self.registry2.send_event("sender", "ready")
+        self.registry2.add_observer(one_shot, "sender", "ready", max_calls=1)
+        self.registry2.send_event("sender", "ready")
+        self.registry2.send_event("sender", "ready")
+        self.assertEqual([Event("sender", "ready")], calls)
+        
+        # Adding the observer again cancels the limit:
+        del calls[:]
+        self.registry2.add_observer(receiver1, named="ready", max_calls=2)
+        self.registry2.add_observer(receiver1, named="ready")
+        for i in range(3):
+            self.registry2.send_event("sender", "ready", i)
+        self.assertEqual(Event("sender", "ready", 2), event_expected1.event)
+        
+        # Re-registering from inside the observer keeps the new registration:
+        def again(event):
+            calls.append(event)
+            self.registry2.add_observer(again, max_calls=1)
+        self.registry2.add_observer(again, max_calls=1)
+        self.registry2.send_event("1", "a")
+        self.registry2.send_event("2", "b")
+        self.assertEqual([Event("1", "a"), Event("2", "b")], calls)
+        
+        with self.assertRaises(AssertionError):
+            self.registry2.add_observer(receiver1, max_calls=0)
+        
+    def test_decorator_max_calls(self):
+        calls = []
+        @observer(named="once", registry=self.registry2, max_calls=1)
+        def receiver(event):
+            calls.append(event)
+        self.registry2.send_event("sender", "once")
+        self.registry2.send_event("sender", "once")
+        self.assertEqual([Event("sender", "once")], calls)
+        
+    def test_sticky_events(self):
+        self.registry2.make_sticky("config.loaded")
+        self.registry2.make_sticky("leader.changed", "cluster")
+        self.registry2.send_event("app", "config.loaded", 1)
+        self.registry2.send_event("app", "config.loaded", 2)
+        self.registry2.send_event("cluster", "leader.changed", "a")
+        self.registry2.send_event("other", "leader.changed", "b")
+        
+        self.registry2.add_observer(receiver1, named="config.loaded", \
+                                    replay=True)
+        self.assertEqual(Event("app", "config.loaded", 2), \
+                         event_expected1.event)
+        self.registry2.add_observer(receiver3, "other", replay=True)
+        self.assertEqual(None, event_expected3.event)
+        self.registry2.add_observer(receiver3, "cluster", "leader.changed", \
+                                    replay=True)
+        self.assertEqual(Event("cluster", "leader.changed", "a"), \
+                         event_expected3.event)
+        # Without replay, nothing is received:
+        self.registry2.add_observer(self.observer4, named="config.loaded")
+        self.assertEqual(None, event_expected4.event)
+        
+        # Replay to an observer of all events with max_calls:
+        recorder = Recorder()
+        self.registry2.add_observer(recorder, replay=True, max_calls=1)
+        self.assertEqual(1, len(recorder.events))
+        self.registry2.send_event("app", "x")
+        self.assertEqual(1, len(recorder.events))
+        
+        # Removing the sticky name forgets its events:
+        self.registry2.remove_sticky("config.loaded")
+        self.registry2.add_observer(receiver2, replay=True)
+        self.assertEqual(Event("cluster", "leader.changed", "a"), \
+                         event_expected2.event)
+        
+    def test_sticky_events_capacity(self):
+        registry = ObserverRegistry(sticky_capacity=2)
+        registry.make_sticky("state")
+        for sender in ("a", "b", "c"):
+            registry.send_event(sender, "state")
+        recorder = Recorder()
+        registry.add_observer(recorder, named="state", replay=True)
+        self.assertEqual(set(["b", "c"]), \
+                         set(e.sender for e in recorder.events))
+        
+    def test_query_event(self):
+        calls = []
+        class Answer(object):
+            def __init__(self, value):
+                self.value = value
+            def __call__(self, event):
+                calls.append(self.value)
+                return self.value
+        answers = [Answer(None), Answer(1), Answer(2)]
+        for answer in answers:
+            self.registry2.add_observer(answer, named="lookup")
+        self.registry2.add_observer(zero_param_func, named="lookup")
+        
+        results = self.registry2.query_event("sender", "lookup")
+        self.assertEqual([], calls)
+        self.assertEqual(set([None, 1, 2]), set(results))
+        self.assertEqual(3, len(calls))
+        
+        self.assertEqual(3, self.registry2.query_event("sender", "lookup", \
+          reducer=lambda total, value: total + (value or 0), initial=0))
+        
+        # Stops at the first answer:
+        del calls[:]
+        result = self.registry2.query_event(Event("sender", "lookup"), \
+                                            first=True)
+        self.assertTrue(result in (1, 2))
+        self.assertTrue(len(calls) < 4)
+        self.assertEqual(result, [value for value in calls \
+                                  if value != None][0])
+        self.assertEqual(None, self.registry2.query_event("sender", \
+                                                          "nobody", first=True))
+        
+        # Without initial value, like the builtin reduce:
+        import operator
+        registry = ObserverRegistry()
+        for answer in answers[1:]:
+            registry.add_observer(answer, named="lookup")
+        self.assertEqual(3, registry.query_event("sender", "lookup", \
+                                                 reducer=operator.add))
+        
+        # The errors before the first answer are not lost:
+        def failing(event):
+            raise ValueError
+        parent = ObserverRegistry()
+        parent.add_observer(failing, named="lookup")
+        child = ObserverRegistry(parent=parent, \
+                                 propagation=ObserverRegistry.PARENT_FIRST)
+        child.add_observer(answers[1], named="lookup")
+        child.error_policy = ObserverRegistry.ERRORS_RAISE_AFTER
+        with self.assertRaises(EventDispatchError):
+            child.query_event("sender", "lookup", first=True)
+        
+    def test_parent_registry(self):
+        order = []
+        class Named(object):
+            def __init__(self, name):
+                self.name = name
+            def __call__(self):
+                order.append(self.name)
+        parent_observer = Named("parent")
+        child_observer = Named("child")
+        self.registry2.add_observer(parent_observer, named="a")
+        
+        for propagation, expected in \
+          ((ObserverRegistry.LOCAL_FIRST, ["child", "parent"]), \
+           (ObserverRegistry.PARENT_FIRST, ["parent", "child"]), \
+           (ObserverRegistry.STOP_PROPAGATION, ["child"])):
+            child = ObserverRegistry(parent=self.registry2, \
+                                     propagation=propagation)
+            child.add_observer(child_observer, named="a")
+            del order[:]
+            child.send_event("sender", "a")
+            self.assertEqual(expected, order)
+            
+            # Events not observed locally reach the parent:
+            child.remove_observer(child_observer)
+            del order[:]
+            child.send_event("sender", "a")
+            self.assertEqual(["parent"], order)
+            
+        # The events sent to the parent do not reach the child:
+        del order[:]
+        child.add_observer(child_observer, named="a")
+        self.registry2.send_event("sender", "a")
+        self.assertEqual(["parent"], order)
+        
+    def test_dispatch_cache_senders(self):
+        import gc
+        import weakref
+        class Model(object):
+            pass
+        model = Model()
+        self.registry2.add_observer(receiver1, named="changed")
+        self.registry2.send_event(model, "changed")
+        self.assertEqual(Event(model, "changed"), event_expected1.event)
+        self.reset_events()
+        model_ref = weakref.ref(model)
+        del model
+        gc.collect()
+        self.assertEqual(None, model_ref())
+        
+        # The observers of a sender are found with the cache of its name:
+        other = Model()
+        self.registry2.add_observer(receiver2, other)
+        self.registry2.send_event(other, "changed")
+        self.assertEqual(Event(other, "changed"), event_expected1.event)
+        self.assertEqual(Event(other, "changed"), event_expected2.event)
+        self.registry2.send_event("sender", "changed")
+        self.assertEqual(Event("sender", "changed"), event_expected1.event)
+        self.assertEqual(Event(other, "changed"), event_expected2.event)
+        
+        # The senders of the ancestors are found by the descendants:
+        root = ObserverRegistry()
+        middle = ObserverRegistry(parent=root)
+        leaf = ObserverRegistry(parent=middle)
+        self.assertFalse(leaf.has_observers("a", "x"))
+        leaf.send_event("a", "x")
+        root.add_observer(receiver3, "a", "x")
+        self.assertTrue(leaf.has_observers("a", "x"))
+        self.assertFalse(leaf.has_observers("b", "x"))
+        leaf.send_event("a", "x", 1)
+        self.assertEqual(Event("a", "x", 1), event_expected3.event)
+        root.remove_observer(receiver3)
+        self.assertFalse(leaf.has_observers("a", "x"))
+        middle.make_sticky("x", "b")
+        leaf.send_event("b", "x", 2)
+        recorder = Recorder()
+        middle.add_observer(recorder, "b", "x", replay=True)
+        self.assertEqual([Event("b", "x", 2)], recorder.events)
+        
+    def test_parent_registry_cache(self):
+        grand_child = ObserverRegistry(parent=ObserverRegistry( \
+          parent=self.registry2))
+        grand_child.send_event("sender", "name")
+        
+        # Adding an observer to an ancestor invalidates the cache:
+        self.registry2.add_observer(receiver1, named="name")
+        grand_child.send_event("sender", "name")
+        self.assertEqual(Event("sender", "name"), event_expected1.event)
+        
+        # Retiring an observer of an ancestor invalidates the cache too:
+        self.reset_events()
+        self.registry2.add_observer(receiver1, named="name", max_calls=1)
+        grand_child.send_event("sender", "name", 1)
+        grand_child.send_event("sender", "name", 2)
+        self.assertEqual(Event("sender", "name", 1), event_expected1.event)
+        
+        # Dead observers of ancestors are removed:
+        self.reset_events()
+        observer = Observer4()
+        self.registry2.add_observer(observer)
+        del observer
+        grand_child.send_event("sender", "name")
+        self.assertEqual(None, event_expected4.event)
+        
+        # Sticky events are retained by the ancestors:
+        self.registry2.make_sticky("state")
+        grand_child.send_event("sender", "state")
+        self.registry2.add_observer(receiver3, replay=True)
+        self.assertEqual(Event("sender", "state"), event_expected3.event)
+        
+    def test_sharded_registry(self):
+        for shard_by in (ShardedObserverRegistry.BY_NAME, \
+                         ShardedObserverRegistry.BY_SENDER_AND_NAME):
+            registry = ShardedObserverRegistry(4, shard_by)
+            all_events = Recorder()
+            registry.add_observer(all_events)
+            registry.add_observer(receiver1, named="a")
+            registry.add_observer(receiver2, "s", "b")
+            registry.add_observer(receiver3, "s")
+            for name in "abc":
+                registry.send_event("s", name)
+            self.assertEqual([Event("s", n) for n in "abc"], \
+                             sorted(all_events.events, key=lambda e: e.name))
+            self.validate_events((Event("s", "a"), Event("s", "b"), \
+                                  Event("s", "c"), None, None))
+            self.reset_events()
+            
+            # Adding again moves the registration to another shard:
+            registry.add_observer(receiver1, named="c")
+            registry.send_event("s", "a")
+            self.assertEqual(None, event_expected1.event)
+            
+            registry.make_sticky("state")
+            registry.send_event("s2", "state")
+            registry.add_observer(receiver1, replay=True)
+            self.assertEqual(Event("s2", "state"), event_expected1.event)
+            registry.remove_observer(all_events)
+            registry.add_observer(all_events, named="d", max_calls=1)
+            registry.send_event("s", "d")
+            registry.send_event("s", "d")
+            self.assertEqual(6, len(all_events.events))
+            registry.clear()
+            self.reset_events()
+            
+    def test_sharded_registry_remove(self):
+        registry = ShardedObserverRegistry(4)
+        recorder = Recorder()
+        for named in ("a", "b", None, "c"):
+            registry.add_observer(recorder, named=named)
+        for name in "abc":
+            registry.send_event("s", name)
+        self.assertEqual(["c"], [event.name for event in recorder.events])
+        registry.remove_observer(recorder)
+        registry.remove_observer(Recorder())
+        registry.send_event("s", "c")
+        self.assertEqual(1, len(recorder.events))
+        self.assertFalse(registry.has_observers("s", "c"))
+        
+    def test_sharded_registry_workers(self):
+        registry = ShardedObserverRegistry(4, workers=True)
+        lock = threading.Lock()
+        received = []
+        class Counter(object):
+            def __call__(self, event):
+                with lock:
+                    received.append(event)
+        counter = Counter()
+        registry.add_observer(counter)
+        names = ["name%d" % i for i in range(8)]
+        threads = [threading.Thread(target=lambda name=name: \
+          [registry.send_event("s", name, i) for i in range(50)]) \
+          for name in names]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        registry.join()
+        self.assertEqual(400, len(received))
+        
+        # Events of a name are notified in order:
+        infos = [event.info for event in received if event.name == "name0"]
+        self.assertEqual(range(50), infos)
+        registry.close()
+        registry.send_event("s", "after")
+        self.assertEqual(401, len(received))
+        
+    def test_event_bridge(self):
+        directory = tempfile.mkdtemp()
+        broker = EventBroker(os.path.join(directory, "broker"))
+        try:
+            registries = [ObserverRegistry() for i in range(3)]
+            bridges = [EventBridge(registry, broker.path, ["a", "b"], 2) \
+                       for registry in registries]
+            received = threading.Condition()
+            class Receiver(object):
+                def __init__(self):
+                    self.events = []
+                def __call__(self, event):
+                    with received:
+                        self.events.append(event)
+                        received.notify_all()
+            receivers = [Receiver() for registry in registries]
+            for registry, receiver in zip(registries, receivers):
+                registry.add_observer(receiver)
+            
+            sender = Prototype()
+            registries[0].send_event("s", "a", {"value": 1})
+            registries[0].send_event(sender, "b")
+            registries[0].send_event("s", "c")
+            for i in range(5):
+                registries[1].send_event(i, "b")
+            for bridge in bridges:
+                bridge.flush()
+            counts = [8, 7, 7]
+            with received:
+                for i in range(50):
+                    if [len(r.events) for r in receivers] == counts:
+                        break
+                    received.wait(0.1)
+            
+            # Only the other processes receive the events:
+            self.assertEqual(counts, [len(r.events) for r in receivers])
+            remote_events = [e for e in receivers[2].events \
+                             if e.sender.origin == bridges[0].origin]
+            remote_events.sort(key=lambda e: e.name)
+            self.assertEqual(Event(RemoteSender(bridges[0].origin, "s"), \
+                                   "a", {"value": 1}), remote_events[0])
+            self.assertTrue(remote_events[1].sender.sender_id \
+                            .endswith("Prototype@%x" % id(sender)))
+            self.assertEqual(range(5), sorted(e.sender.sender_id for e in \
+                                              receivers[2].events \
+                                              if e not in remote_events))
+            for bridge in bridges:
+                bridge.close()
+        finally:
+            broker.close()
+            shutil.rmtree(directory)
+    
+    def test_event_bridge_bad_events(self):
+        import logging
+        directory = tempfile.mkdtemp()
+        broker = EventBroker(os.path.join(directory, "broker"))
+        logging.getLogger("neo_observer").disabled = True
+        try:
+            registries = [ObserverRegistry() for i in range(2)]
+            bridges = [EventBridge(registry, broker.path, ["a"], 16) \
+                       for registry in registries]
+            received = threading.Event()
+            names = []
+            def receiver(event):
+                names.append(event.info)
+                if event.info == "last":
+                    received.set()
+            registries[1].add_observer(receiver)
+            
+            # The events that cannot be pickled or unpickled are dropped:
+            registries[0].send_event("s", "a", "first")
+            registries[0].send_event("s", "a", lambda: None)
+            registries[0].send_event("s", "a", "second")
+            bridges[0].flush()
+            registries[0].send_event("s", "a", FailsToLoad())
+            bridges[0].flush()
+            registries[0].send_event("s", "a", "last")
+            bridges[0].flush()
+            self.assertTrue(received.wait(5))
+            self.assertEqual(["first", "second", "last"], names)
+            for bridge in bridges:
+                bridge.close()
+        finally:
+            logging.getLogger("neo_observer").disabled = False
+            broker.close()
+            shutil.rmtree(directory)
+        
+    def test_event_codec(self):
+        sender = Prototype()
+        codec = EventCodec(out_of_band_threshold=16)
+        codec.register_sender(sender, 7)
+        codec.register_name("frame", 3)
+        pixels = bytearray("x" * 100)
+        event = Event(sender, "frame", {"pixels": pixels, "index": 1, \
+                                        "tag": "short", "nested": ["y" * 20]})
+        buffers = codec.encode(event)
+        self.assertEqual(3, len(buffers))
+        
+        # The out of band buffers reference the original memory:
+        pixels[0] = "z"
+        decoded = codec.decode(buffers)
+        self.assertTrue(decoded.sender is sender)
+        self.assertEqual("frame", decoded.name)
+        self.assertEqual("z" + "x" * 99, decoded.info["pixels"].tobytes())
+        self.assertEqual(["y" * 20], [v.tobytes() for v in \
+                                      decoded.info["nested"]])
+        self.assertEqual((1, "short"), (decoded.info["index"], \
+                                        decoded.info["tag"]))
+        
+        # Senders and names not registered are inline:
+        other = EventCodec()
+        for event in (Event("sender", u"\xe9v\xe9nement", None), \
+                      Event(10, "frame", "info")):
+            self.assertEqual(event, other.loads(other.dumps(event)))
+        # Senders registered only when encoding are decoded as identifiers:
+        other.register_name("frame", 3)
+        self.assertEqual(Event(7, "frame", {"index": 1}), other.decode( \
+          codec.encode(Event(sender, "frame", {"index": 1}))))
+        
+    def test_send_batch(self):
+        batch = EventBatch(["a", "b", "a"], "metric", {"value": [1, 2, 3]})
+        all_batches = Recorder()
+        sender_batches = Recorder()
+        events = Recorder()
+        self.registry2.add_observer(all_batches, named="metric", batch=True)
+        self.registry2.add_observer(sender_batches, "a", batch=True)
+        self.registry2.add_observer(events, "a", "metric")
+        self.registry2.add_observer(receiver1, "b")
+        self.registry2.make_sticky("metric")
+        self.registry2.send_batch(batch)
+        
+        self.assertEqual([batch], all_batches.events)
+        self.assertEqual(1, len(sender_batches.events))
+        self.assertEqual(["a", "a"], sender_batches.events[0].senders)
+        self.assertEqual({"value": [1, 3]}, sender_batches.events[0].info)
+        self.assertEqual([Event("a", "metric", {"value": 1}), \
+                          Event("a", "metric", {"value": 3})], events.events)
+        self.assertEqual(Event("b", "metric", {"value": 2}), \
+                         event_expected1.event)
+        self.assertTrue(events.events[0] is batch[0])
+        self.assertEqual([batch[0], batch[1], batch[2]], list(batch))
+        
+        # The last event of each sender is retained:
+        self.registry2.add_observer(receiver3, "a", "metric", replay=True)
+        self.assertEqual(Event("a", "metric", {"value": 3}), \
+                         event_expected3.event)
+        
+        # Batch observers receive single events sent with send_event:
+        self.registry2.send_event("b", "metric")
+        self.assertEqual(Event("b", "metric"), all_batches.events[-1])
+        self.assertEqual(3, len(EventBatch(["a"] * 3, "x")))
+        
+        # The events are not created for batch observers:
+        class Column(list):
+            reads = 0
+            def __getitem__(self, index):
+                Column.reads += 1
+                return list.__getitem__(self, index)
+        registry = ObserverRegistry()
+        batches = Recorder()
+        registry.add_observer(batches, named="metric", batch=True)
+        registry.send_batch(EventBatch(range(100), "metric", \
+                                       {"value": Column(range(100))}))
+        self.assertEqual(1, len(batches.events))
+        self.assertEqual(0, Column.reads)
+        registry.make_sticky("metric")
+        registry.send_batch(EventBatch(range(100), "metric", \
+                                       {"value": Column(range(100))}))
+        self.assertEqual(100, Column.reads)
+        
+    def test_stream(self):
+        with self.registry2.stream(named="job", capacity=3) as stream:
+            for i in range(5):
+                self.registry2.send_event("s", "job", i)
+            self.registry2.send_event("s", "other")
+            self.assertEqual(2, stream.dropped)
+            self.assertEqual([2, 3], [e.info for e in stream.take(2, 0)])
+            self.assertEqual([4], [e.info for e in stream.take(10, 0.01)])
+        self.registry2.send_event("s", "job")
+        self.assertEqual([], list(stream))
+        
+        stream = self.registry2.stream(capacity=2, \
+                                       overflow=EventStream.DROP_NEWEST)
+        for i in range(3):
+            self.registry2.send_event("s", "job", i)
+        stream.close()
+        self.assertEqual([0, 1], [e.info for e in stream])
+        
+    def test_stream_threads(self):
+        stream = self.registry2.stream(named="job", capacity=2, \
+                                       overflow=EventStream.BLOCK)
+        def send():
+            for i in range(20):
+                self.registry2.send_event("s", "job", i)
+            stream.close()
+        thread = threading.Thread(target=send)
+        thread.start()
+        self.assertEqual(range(20), [e.info for e in stream])
+        thread.join()
+        self.assertEqual(0, stream.dropped)
+        
+    def test_rate(self):
+        import neo_observer
+        now = [0.0]
+        monotonic = neo_observer._monotonic
+        neo_observer._monotonic = lambda: now[0]
+        try:
+            recorders = dict((policy, Recorder()) for policy in \
+                             (ObserverRegistry.RATE_DROP, \
+                              ObserverRegistry.RATE_KEEP_LATEST, \
+                              ObserverRegistry.RATE_QUEUE))
+            for policy, recorder in recorders.iteritems():
+                self.registry2.add_observer(recorder, named="tick", \
+                                            rate=(2, 1), rate_policy=policy)
+            for i in range(5):
+                self.registry2.send_event("s", "tick", i)
+            for policy, recorder in recorders.iteritems():
+                self.assertEqual([0, 1], [e.info for e in recorder.events])
+                self.assertEqual(3, self.registry2.suppressed_count(recorder))
+            self.assertEqual(None, self.registry2.suppressed_count(receiver1))
+                
+            # Half a second gives a token:
+            now[0] = 0.5
+            self.assertEqual(2, self.registry2.flush_throttled())
+            self.assertEqual([0, 1, 4], [e.info for e in \
+              recorders[ObserverRegistry.RATE_KEEP_LATEST].events])
+            self.assertEqual([0, 1, 2], [e.info for e in \
+              recorders[ObserverRegistry.RATE_QUEUE].events])
+            
+            # The queued events are delivered before the new ones:
+            now[0] = 1.5
+            self.registry2.send_event("s", "tick", 5)
+            self.assertEqual([0, 1, 2, 3, 4], [e.info for e in \
+              recorders[ObserverRegistry.RATE_QUEUE].events])
+            self.assertEqual([0, 1, 5], [e.info for e in \
+              recorders[ObserverRegistry.RATE_DROP].events])
+            now[0] = 2.5
+            self.assertEqual(1, self.registry2.flush_throttled())
+            self.assertEqual(5, recorders[ObserverRegistry.RATE_QUEUE] \
+                             .events[-1].info)
+        finally:
+            neo_observer._monotonic = monotonic
+        
+    def test_rate_queue_bounds(self):
+        import neo_observer
+        now = [0.0]
+        monotonic = neo_observer._monotonic
+        neo_observer._monotonic = lambda: now[0]
+        try:
+            registry = ObserverRegistry()
+            registry.rate_queue_capacity = 3
+            recorder = Recorder()
+            registry.add_observer(recorder, named="tick", rate=(3, 1), \
+                                  rate_policy=ObserverRegistry.RATE_QUEUE)
+            for i in range(10):
+                registry.send_event("s", "tick", i)
+            self.assertEqual(7, registry.suppressed_count(recorder))
+            
+            # Only the newest queued events are kept:
+            now[0] = 10.0
+            self.assertEqual(3, registry.flush_throttled())
+            self.assertEqual([0, 1, 2, 7, 8, 9], \
+                             [e.info for e in recorder.events])
+            
+            # No queued event is delivered while the breaker is open:
+            def failing(event):
+                raise ValueError
+            breaker = CircuitBreaker(max_failures=1, cooldown=100)
+            registry.error_policy = ObserverRegistry.ERRORS_LOG
+            registry.add_observer(failing, named="save", breaker=breaker, \
+              rate=(1, 1), rate_policy=ObserverRegistry.RATE_QUEUE)
+            import logging
+            logging.getLogger("neo_observer").disabled = True
+            try:
+                for i in range(3):
+                    registry.send_event("s", "save", i)
+                self.assertEqual(CircuitBreaker.OPEN, breaker.state)
+                now[0] = 20.0
+                self.assertEqual(0, registry.flush_throttled())
+                self.assertEqual(CircuitBreaker.OPEN, breaker.state)
+                
+                # Nor once a queued event opens it:
+                registry.remove_observer(failing)
+                registry.rate_queue_capacity = 10
+                calls = []
+                def flaky(event):
+                    calls.append(event.info)
+                    if event.info == 5:
+                        raise ValueError
+                registry.add_observer(flaky, named="load", rate=(10, 100), \
+                  rate_policy=ObserverRegistry.RATE_QUEUE, \
+                  breaker=CircuitBreaker(max_failures=1, cooldown=1000))
+                for i in range(10, 20) + range(10):
+                    registry.send_event("s", "load", i)
+                now[0] = 120.0
+                self.assertEqual(6, registry.flush_throttled())
+                self.assertEqual(range(10, 20) + range(6), calls)
+            finally:
+                logging.getLogger("neo_observer").disabled = False
+            
+            # The clock going backwards does not block the observer:
+            recorder = Recorder()
+            registry.add_observer(recorder, named="step", rate=(1, 1))
+            now[0] = 1000.0
+            registry.send_event("s", "step", 0)
+            now[0] = 0.0
+            registry.send_event("s", "step", 1)
+            now[0] = 1.0
+            registry.send_event("s", "step", 2)
+            self.assertEqual([0, 2], [e.info for e in recorder.events])
+        finally:
+            neo_observer._monotonic = monotonic
+        
+    def test_sample(self):
+        every = Recorder()
+        probability = Recorder()
+        by_sender = Recorder()
+        self.registry2.add_observer(every, named="request", sample=10)
+        self.registry2.add_observer(probability, named="request", \
+                                    sample=0.1, sample_seed=1)
+        self.registry2.add_observer(by_sender, sample=0.5, sample_seed=2, \
+                                    sample_by_sender=True)
+        for i in range(1000):
+            self.registry2.send_event(i % 20, "request", i)
+        self.assertEqual(range(0, 1000, 10), [e.info for e in every.events])
+        self.assertTrue(50 < len(probability.events) < 150)
+        
+        # The same seed gives the same sample:
+        registry = ObserverRegistry()
+        other = Recorder()
+        registry.add_observer(other, sample=0.1, sample_seed=1)
+        for i in range(1000):
+            registry.send_event(i % 20, "request", i)
+        self.assertEqual(probability.events, other.events)
+        
+        senders = set(e.sender for e in by_sender.events)
+        self.assertTrue(0 < len(senders) < 20)
+        self.assertEqual(len(senders) * 50, len(by_sender.events))
+        
+        @observer(named="x", registry=self.registry2, sample=2)
+        def sampled(event):
+            every.events.append(event)
+        del every.events[:]
+        for i in range(4):
+            self.registry2.send_event("s", "x")
+        self.assertEqual(2, len(every.events))
+        
+    def test_sample_batch(self):
+        registry = ObserverRegistry()
+        by_sender = Recorder()
+        registry.add_observer(by_sender, named="tick", batch=True, \
+                              sample=0.5, sample_seed=1, sample_by_sender=True)
+        senders = range(100)
+        registry.send_batch(EventBatch(senders, "tick"))
+        with registry.deferred():
+            for sender in senders:
+                registry.send_event(sender, "tick")
+        
+        # The batches only have the events of the senders sampled:
+        self.assertEqual(2, len(by_sender.events))
+        sampled = [event.sender for event in by_sender.events[0]]
+        self.assertTrue(0 < len(sampled) < 100)
+        self.assertEqual(sampled, [event.sender for event \
+                                   in by_sender.events[1]])
+        
+    def test_stats(self):
+        registry = ObserverRegistry()
+        stats = registry.stats()
+        self.assertEqual({}, stats["subscriptions"])
+        self.assertEqual(None, stats["hot_keys"])
+        
+        observer4 = Observer4()
+        registry.add_observer(observer4)
+        registry.add_observer(self.observer5, "s")
+        registry.add_observer(receiver1, named="a")
+        registry.add_observer(receiver2, named="a")
+        registry.add_observer(receiver3, named="b")
+        registry.add_observer(zero_param_func, "s", "a")
+        class Pinning(object):
+            __slots__ = ("data",)
+            def __call__(self):
+                pass
+        big = Pinning()
+        big.data = [0] * 10000
+        registry.add_observer(big)
+        registry.count_sends()
+        for i in range(3):
+            registry.send_event("s", "a")
+        registry.send_event("s", "b")
+        # Only the senders without observers of their own use the cache:
+        registry.send_event("t", "a")
+        registry.send_event("t", "b")
+        del observer4
+        
+        stats = registry.stats(top=1)
+        self.assertEqual({"all events": 2, "senders": 1, "names": 3, \
+                          "senders and names": 1}, stats["subscriptions"])
+        self.assertEqual([("a", 2)], stats["largest_fan_out"]["names"])
+        self.assertEqual([(("s", "a"), 1)], \
+                         stats["largest_fan_out"]["senders and names"])
+        self.assertEqual(1, stats["dead_observers"])
+        self.assertEqual([(("s", "a"), 3)], stats["hot_keys"])
+        self.assertEqual(1, len(stats["hard_ref_observers"]))
+        self.assertTrue(big is stats["hard_ref_observers"][0][0])
+        self.assertTrue(stats["hard_ref_observers"][0][1] > 80000)
+        self.assertEqual(2, stats["dispatch_cache_entries"])
+        self.assertTrue(stats["bytes"] > 0)
+        
+        sharded = ShardedObserverRegistry(2)
+        sharded.add_observer(receiver1, named="a")
+        sharded.add_observer(receiver2)
+        sharded.count_sends()
+        sharded.send_event("s", "a")
+        stats = sharded.stats()
+        self.assertEqual({"all events": 1, "names": 1}, \
+                         stats["subscriptions"])
+        self.assertEqual([(("s", "a"), 1)], stats["hot_keys"])
+        
+        # The keys least sent are forgotten when the capacity is reached:
+        import gc
+        import weakref
+        class Model(object):
+            pass
+        registry = ObserverRegistry()
+        registry.count_sends(capacity=4)
+        for i in range(10):
+            registry.send_event("s", "a")
+        model = Model()
+        model_ref = weakref.ref(model)
+        registry.send_event(model, "a")
+        del model
+        for i in range(100):
+            registry.send_event(i, "a")
+        gc.collect()
+        self.assertEqual(None, model_ref())
+        hot_keys = registry.stats(top=10)["hot_keys"]
+        self.assertTrue(len(hot_keys) <= 4)
+        self.assertEqual((("s", "a"), 10), hot_keys[0])
+        
+    def test_has_observers(self):
+        registry = self.registry2
+        self.assertFalse(registry.has_observers("s", "a"))
+        registry.add_observer(receiver1, "s")
+        registry.add_observer(receiver2, named="a")
+        registry.add_observer(receiver3, "t", "b")
+        self.assertTrue(registry.has_observers("s", "z"))
+        self.assertTrue(registry.has_observers("x", "a"))
+        self.assertTrue(registry.has_observers("t", "b"))
+        self.assertFalse(registry.has_observers("t", "c"))
+        self.assertFalse(registry.has_observers("u", "b"))
+        registry.remove_observer(receiver3)
+        self.assertFalse(registry.has_observers("t", "b"))
+        registry.add_observer(self.observer4)
+        self.assertTrue(registry.has_observers("t", "b"))
+        registry.remove_observer(self.observer4)
+        
+        # The ancestors are checked:
+        child = ObserverRegistry(parent=registry)
+        self.assertTrue(child.has_observers("x", "a"))
+        self.assertFalse(child.has_observers("x", "b"))
+        sharded = ShardedObserverRegistry(4)
+        sharded.add_observer(receiver3, named="b")
+        self.assertTrue(sharded.has_observers("x", "b"))
+        self.assertFalse(sharded.has_observers("x", "c"))
+        
+        # Events without observers are not created but are counted:
+        registry.count_sends()
+        registry.send_event("x", "c")
+        self.assertEqual([(("x", "c"), 1)], registry.stats()["hot_keys"])
+        with self.assertRaises(AssertionError):
+            registry.send_event(None, "c")
+        
+        # Sticky events are retained without observers:
+        registry.make_sticky("c")
+        registry.send_event("x", "c")
+        registry.add_observer(receiver1, replay=True)
+        self.assertEqual(Event("x", "c"), event_expected1.event)
+        
+    def test_info_factory(self):
+        calls = []
+        def factory():
+            calls.append(None)
+            return {"diff": 1}
+        
+        # Not called without observers or with zero parameter observers:
+        self.registry2.send_event("s", "changed", info_factory=factory)
+        self.registry2.add_observer(zero_param_func, named="changed")
+        self.registry2.send_event("s", "changed", info_factory=factory)
+        self.assertEqual([], calls)
+        
+        # Called once for all the observers:
+        class InfoReader(object):
+            def __call__(self, event):
+                return event.info
+        readers = [InfoReader(), InfoReader()]
+        for reader in readers:
+            self.registry2.add_observer(reader, named="changed")
+        self.assertEqual([{"diff": 1}, {"diff": 1}], [info for info in \
+          self.registry2.query_event("s", "changed", info_factory=factory) \
+          if info != None])
+        self.assertEqual(1, len(calls))
+        
+        event = Event("s", "changed", info_factory=factory)
+        self.assertFalse(event.has_info)
+        self.assertEqual(Event("s", "changed", {"diff": 1}), event)
+        self.assertTrue(event.has_info)
+        event.info = 2
+        self.assertEqual(2, event.info)
+        import cPickle
+        event = Event("s", "changed", info_factory=factory)
+        self.assertEqual(event, cPickle.loads(cPickle.dumps(event)))
+        with self.assertRaises(AssertionError):
+            Event("s", "changed", 1, factory)
+        
+        # A factory may read the info of another event:
+        inner = Event("s", "inner", info_factory=lambda: 1)
+        outer = Event("s", "outer", info_factory=lambda: inner.info + 1)
+        self.assertEqual(2, outer.info)
+        
+    def test_observes(self):
+        registry = self.registry2
+        class Widget(Observing):
+            observer_registry = registry
+            def __init__(self):
+                self.received = []
+            @observes(named="resized")
+            @observes(sent_by="window", named="moved")
+            def geometry_changed(self, event):
+                self.received.append(event.name)
+            @observes(sent_by="window")
+            def refresh(self):
+                self.received.append("refresh")
+        class QuietWidget(Widget):
+            def refresh(self):
+                pass
+        
+        widgets = [Widget() for i in range(3)]
+        quiet_widget = QuietWidget()
+        registry.send_event("window", "moved")
+        registry.send_event("other", "resized")
+        registry.send_event("other", "moved")
+        for widget in widgets:
+            self.assertEqual(["moved", "refresh", "resized"], \
+                             sorted(widget.received))
+        self.assertEqual(["moved", "resized"], quiet_widget.received)
+        
+        # Weak references:
+        del widgets, widget
+        registry.send_event("window", "moved")
+        self.assertEqual(2, sum(registry.stats()["subscriptions"].values()))
+        registry.remove_observer(quiet_widget)
+        self.assertFalse(registry.has_observers("window", "moved"))
+        
+    def test_observes_sharded(self):
+        registry = ShardedObserverRegistry(shards=4)
+        class Counter(Observing):
+            observer_registry = registry
+            def __init__(self):
+                self.count = 0
+            @observes(named="a")
+            @observes(named="b")
+            @observes()
+            def count_event(self):
+                self.count += 1
+        counter = Counter()
+        registry.send_event("s", "a")
+        registry.send_event("s", "b")
+        registry.send_event("s", "c")
+        self.assertEqual(5, counter.count)
+        
+    def test_event_type(self):
+        saved, closed = EventType.declare("test.saved", "test.closed")
+        self.assertTrue(saved is EventType("test.saved"))
+        self.assertTrue(saved is EventType.get("test.saved"))
+        self.assertTrue(closed is EventType.get(closed.id))
+        self.assertEqual(None, EventType.get("test.undeclared"))
+        self.assertEqual("test.saved", saved)
+        import cPickle
+        self.assertTrue(saved is cPickle.loads(cPickle.dumps(saved)))
+        
+        # Declared and string names are interchangeable:
+        recorders = [Recorder(), Recorder(), Recorder()]
+        self.registry2.add_observer(recorders[0], named="test.saved")
+        self.registry2.add_observer(recorders[1], named=saved)
+        self.registry2.add_observer(recorders[2], named=closed)
+        self.registry2.send_event("s", saved)
+        self.registry2.send_event("s", "test.saved")
+        self.registry2.send_event("s", "test.closed")
+        self.assertEqual([2, 2, 1], [len(recorder.events) for recorder \
+                                     in recorders])
+        self.registry2.remove_observer(recorders[1])
+        self.registry2.clear()
+        self.registry2.send_event("s", saved)
+        self.assertEqual([2, 2, 1], [len(recorder.events) for recorder \
+                                     in recorders])
+        
+        # Strict registries only accept declared names:
+        registry = ObserverRegistry()
+        registry.strict_event_types = True
+        registry.add_observer(recorders[0], named="test.saved")
+        with self.assertRaises(AssertionError):
+            registry.add_observer(recorders[0], named="test.svaed")
+        
+    def test_send_event_after(self):
+        registry = ObserverRegistry()
+        registry.scheduler_thread = False
+        recorder = Recorder()
+        registry.add_observer(recorder, named="timeout")
+        later = registry.send_event_after(60, "job2", "timeout")
+        registry.send_event_after(0, "job1", "timeout")
+        cancelled = registry.send_event_at(0, "job0", "timeout")
+        self.assertTrue(cancelled.cancel())
+        self.assertFalse(cancelled.cancel())
+        self.assertEqual([], recorder.events)
+        self.assertEqual(1, registry.run_pending())
+        self.assertEqual(["job1"], [event.sender for event \
+                                    in recorder.events])
+        self.assertTrue(later.cancel())
+        self.assertEqual(0, registry.run_pending())
+        
+    def test_send_event_after_thread(self):
+        registry = ObserverRegistry()
+        done = threading.Event()
+        senders = []
+        def on_timeout(event):
+            senders.append(event.sender)
+            if event.sender == "last":
+                done.set()
+        registry.add_observer(on_timeout, named="timeout")
+        registry.send_event_after(0.2, "last", "timeout")
+        for i in range(10):
+            registry.send_event_after(0.1, i, "timeout")
+        for i in range(10, 20):
+            registry.send_event_after(0.1, i, "timeout").cancel()
+        registry.send_event_after(0.01, "first", "timeout")
+        self.assertTrue(done.wait(5))
+        self.assertEqual(["first"] + range(10) + ["last"], senders)
+        
+    def test_deferred(self):
+        recorder = Recorder()
+        self.registry2.add_observer(recorder, sent_by="model")
+        batches = Recorder()
+        self.registry2.add_observer(batches, named="saved", batch=True)
+        with self.registry2.deferred():
+            self.registry2.send_event("model", "changed", {"field": "a"})
+            with self.registry2.deferred():
+                self.registry2.send_event("model", "changed", {"field": "b"})
+                self.registry2.send_event("model", "saved")
+                self.registry2.send_event("model", "changed", {"field": "a"})
+            self.assertEqual([], recorder.events)
+            self.registry2.send_event("other", "saved")
+        self.assertEqual([Event("model", "changed", {"field": "a"}), \
+                          Event("model", "changed", {"field": "b"}), \
+                          Event("model", "saved")], recorder.events)
+        self.assertEqual(1, len(batches.events))
+        self.assertEqual([Event("model", "saved"), Event("other", "saved")], \
+                         list(batches.events[0]))
+        
+        # By key, keeping the last event:
+        del recorder.events[:]
+        def by_sender_name(event):
+            return event.sender, event.name
+        try:
+            with self.registry2.deferred(by_sender_name):
+                self.registry2.send_event("model", "changed", {"field": "a"})
+                self.registry2.send_event("model", "changed", {"field": "b"})
+                raise ValueError
+        except ValueError:
+            pass
+        self.assertEqual([Event("model", "changed", {"field": "b"})], \
+                         recorder.events)
+        
+        # Hashable and unhashable info:
+        del recorder.events[:]
+        with self.registry2.deferred():
+            for i in range(1000):
+                self.registry2.send_event("model", "changed", i % 10)
+            self.registry2.send_event("model", "changed", [1])
+            self.registry2.send_event("model", "changed", [1])
+            self.registry2.send_event("model", "saved", 3)
+        self.assertEqual(range(10) + [[1], 3], \
+                         [e.info for e in recorder.events])
+        
+        # The batches are all sent before raising:
+        registry = ObserverRegistry()
+        def failing(event):
+            raise ValueError
+        registry.add_observer(failing, named="x")
+        recorder = Recorder()
+        registry.add_observer(recorder, named="y")
+        with self.assertRaises(ValueError):
+            with registry.deferred():
+                registry.send_event("s", "x")
+                registry.send_event("s", "y")
+        self.assertEqual([Event("s", "y")], recorder.events)
+        registry.error_policy = ObserverRegistry.ERRORS_RAISE_AFTER
+        def failing_too(event):
+            raise KeyError
+        registry.add_observer(failing_too, named="y")
+        with self.assertRaises(EventDispatchError) as context:
+            with registry.deferred():
+                registry.send_event("s", "x")
+                registry.send_event("s", "y")
+        self.assertEqual(2, len(context.exception.errors))
+        
+    def test_breadth_first(self):
+        registry = ObserverRegistry()
+        registry.breadth_first = True
+        names = []
+        def on_event(event):
+            names.append(event.name)
+            if event.name == "root":
+                registry.send_event("s", "child1")
+                registry.send_event("s", "child2")
+            elif event.name == "child1":
+                registry.send_event("s", "grandchild")
+        registry.add_observer(on_event)
+        registry.send_event("s", "root")
+        self.assertEqual(["root", "child1", "child2", "grandchild"], names)
+        
+        # Deeper than the recursion limit:
+        import sys
+        count = [0]
+        def on_count(event):
+            count[0] += 1
+            if count[0] < sys.getrecursionlimit() * 2:
+                registry.send_event(count[0], "count")
+        registry.add_observer(on_count, named="count")
+        registry.send_event(0, "count")
+        self.assertEqual(sys.getrecursionlimit() * 2, count[0])
+        
+    def test_breadth_first_dedup(self):
+        registry = ObserverRegistry()
+        registry.breadth_first = True
+        registry.cascade_dedup = True
+        def on_item(event):
+            registry.send_event("list", "changed", {"size": 1})
+            registry.send_event("list", "changed", {"size": 2})
+            registry.send_event("list", "resized", 2)
+        registry.add_observer(on_item, named="item.added")
+        recorder = Recorder()
+        registry.add_observer(recorder, named="changed")
+        resized = Recorder()
+        registry.add_observer(resized, named="resized")
+        def on_items(event):
+            for i in range(3):
+                registry.send_event(i, "item.added")
+        registry.add_observer(on_items, named="items.added")
+        registry.send_event("s", "items.added")
+        self.assertEqual([{"size": 1}, {"size": 2}], [event.info for event \
+                                                      in recorder.events])
+        self.assertEqual([Event("list", "resized", 2)], resized.events)
+        
+        # The events already dispatched are sent again:
+        registry.send_event("s", "items.added")
+        self.assertEqual(4, len(recorder.events))
+        self.assertEqual(2, len(resized.events))
+        
+    def test_breadth_first_limits(self):
+        registry = ObserverRegistry()
+        registry.breadth_first = True
+        registry.max_cascade_depth = 10
+        def on_ping(event):
+            registry.send_event(event.sender, "pong")
+        def on_pong(event):
+            registry.send_event(event.sender + 1, "ping")
+        registry.add_observer(on_ping, named="ping")
+        registry.add_observer(on_pong, named="pong")
+        with self.assertRaises(EventCascadeError):
+            registry.send_event(0, "ping")
+        
+        registry.max_cascade_depth = None
+        registry.cascade_cycles = ObserverRegistry.CYCLE_RAISE
+        def on_pong_cycle(event):
+            registry.send_event(event.sender, "ping")
+        registry.remove_observer(on_pong)
+        registry.add_observer(on_pong_cycle, named="pong")
+        with self.assertRaises(EventCascadeError):
+            registry.send_event(0, "ping")
+        recorder = Recorder()
+        registry.add_observer(recorder)
+        registry.cascade_cycles = ObserverRegistry.CYCLE_SKIP
+        registry.send_event(0, "ping")
+        self.assertEqual(["ping", "pong"], [event.name for event \
+                                            in recorder.events])
+        
+    def test_error_policy(self):
+        class Failing(object):
+            def __call__(self, event):
+                raise ValueError(event.name)
+        failing = Failing()
+        recorder = Recorder()
+        registry = ObserverRegistry()
+        registry.add_observer(failing, named="save")
+        registry.add_observer(recorder, named="save")
+        with self.assertRaises(ValueError):
+            registry.send_event("s", "save")
+        del recorder.events[:]
+        
+        # The other observers are notified:
+        registry.error_policy = ObserverRegistry.ERRORS_COLLECT
+        registry.send_event("s", "save")
+        self.assertEqual(1, len(recorder.events))
+        errors = registry.take_errors()
+        self.assertEqual([(failing, Event("s", "save"))], \
+                         [error[:2] for error in errors])
+        self.assertTrue(isinstance(errors[0][2], ValueError))
+        self.assertEqual([], registry.take_errors())
+        
+        registry.error_policy = ObserverRegistry.ERRORS_RAISE_AFTER
+        with self.assertRaises(EventDispatchError) as context:
+            registry.send_event("s", "save")
+        self.assertEqual(2, len(recorder.events))
+        self.assertEqual(failing, context.exception.errors[0][0])
+        with self.assertRaises(EventDispatchError):
+            list(registry.query_event("s", "save"))
+        
+    def test_circuit_breaker(self):
+        import neo_observer
+        now = [0.0]
+        monotonic = neo_observer._monotonic
+        neo_observer._monotonic = lambda: now[0]
+        try:
+            class Flaky(object):
+                def __init__(self):
+                    self.calls = 0
+                    self.fails = True
+                def __call__(self, event):
+                    self.calls += 1
+                    if self.fails:
+                        raise ValueError
+            flaky = Flaky()
+            registry = ObserverRegistry()
+            registry.error_policy = ObserverRegistry.ERRORS_LOG
+            breaker = CircuitBreaker(max_failures=2, cooldown=10)
+            registry.add_observer(flaky, named="save", breaker=breaker)
+            import logging
+            logging.getLogger("neo_observer").disabled = True
+            try:
+                for i in range(5):
+                    registry.send_event("s", "save")
+            finally:
+                logging.getLogger("neo_observer").disabled = False
+            self.assertEqual(2, flaky.calls)
+            self.assertEqual(CircuitBreaker.OPEN, \
+                             registry.breaker_state(flaky))
+            self.assertEqual({CircuitBreaker.OPEN: 1}, \
+                             registry.stats()["breakers"])
+            
+            # Probed after the cooldown:
+            now[0] = 10.0
+            self.assertEqual(CircuitBreaker.HALF_OPEN, \
+                             registry.breaker_state(flaky))
+            flaky.fails = False
+            registry.send_event("s", "save")
+            registry.send_event("s", "save")
+            self.assertEqual(4, flaky.calls)
+            self.assertEqual(CircuitBreaker.CLOSED, breaker.state)
+            
+            # Too slow:
+            breaker.latency_budget = 1.0
+            def slow(event):
+                now[0] += 2.0
+            registry.add_observer(slow, named="save", \
+              breaker=CircuitBreaker(max_failures=1, latency_budget=1.0))
+            registry.send_event("s", "save")
+            self.assertEqual(CircuitBreaker.OPEN, registry.breaker_state(slow))
+            self.assertEqual(None, registry.breaker_state(Recorder()))
+            
+            # The cooldown restarts when the clock goes backwards:
+            opened_at = now[0]
+            now[0] = opened_at - 100.0
+            self.assertEqual(CircuitBreaker.OPEN, registry.breaker_state(slow))
+            now[0] = opened_at - 70.0
+            self.assertEqual(CircuitBreaker.HALF_OPEN, \
+                             registry.breaker_state(slow))
+        finally:
+            neo_observer._monotonic = monotonic
+        
     def validate_events(self, results):
         global event_expected1, event_expected2, event_expected3, \
             event_expected4, event_expected5